@@ -0,0 +1,347 @@
+"""
+Benchmarks for the Multivac job lifecycle.
+
+Starts a throwaway redis-server on a free local port, or an in-process
+fakeredis server if redis-server is not installed or --fake is given, and
+measures:
+ - create_job throughput
+ - get_jobs latency, unpaged and a page of 100, as stored jobs grow
+ - append_job_log and append_job_logs lines per second
+ - get_stored_log latency on a large log
+ - create to first output to completed latency through a real JobWorker
+
+Results are written as JSON so runs can be compared, e.g.:
+
+    python benchmarks/bench.py --output before.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+from statistics import mean, median
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+import redis
+import multivac.db
+
+from multivac.db import JobsDB
+
+bench_actions = [ { 'name': 'bench',
+                    'cmd': 'true',
+                    'allow_groups': 'all',
+                    'chatbot_stream': True,
+                    'confirm_required': False } ]
+
+# seconds to wait for the e2e worker to register
+worker_timeout = 30
+
+# run a worker in its own process, so it can be stopped before redis-server
+worker_script = """
+import sys
+from multivac.worker import JobWorker
+JobWorker('localhost', int(sys.argv[1]), sys.argv[2])
+"""
+
+e2e_config = """
+max_concurrent_jobs: 10
+actions:
+  - name: e2e
+    cmd: sh -c 'yes multivac | head -n %d'
+"""
+
+
+class RedisServer(object):
+    """
+    Throwaway redis-server listening on a free local port
+    """
+    def __init__(self, path='redis-server'):
+        self.port = self._free_port()
+        self.dir = tempfile.mkdtemp(prefix='multivac-bench-')
+        self.proc = subprocess.Popen([ path,
+                                       '--port', str(self.port),
+                                       '--bind', '127.0.0.1',
+                                       '--dir', self.dir,
+                                       '--save', '',
+                                       '--appendonly', 'no' ],
+                                     stdout=subprocess.DEVNULL)
+
+        client = redis.StrictRedis(port=self.port)
+        for _ in range(100):
+            try:
+                client.ping()
+                break
+            except redis.exceptions.ConnectionError:
+                time.sleep(0.05)
+        self.version = 'redis-server %s' % client.info()['redis_version']
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    @staticmethod
+    def _free_port():
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+
+class FakeRedisServer(object):
+    """
+    In-process fakeredis server used in place of redis-server, shared by
+    all JobsDB instances created while it runs
+    """
+    def __init__(self):
+        import fakeredis
+
+        server = fakeredis.FakeServer()
+
+        class FakeStrictRedis(fakeredis.FakeStrictRedis):
+            def __init__(self, *args, **kwargs):
+                kwargs.pop('host', None)
+                kwargs.pop('port', None)
+                # clients share the fake server instead of a pool
+                if kwargs.pop('connection_pool', None):
+                    kwargs['decode_responses'] = True
+                kwargs['server'] = server
+                super().__init__(*args, **kwargs)
+
+        self.port = None
+        self.version = 'fakeredis %s' % fakeredis.__version__
+        self._orig = multivac.db.StrictRedis
+        multivac.db.StrictRedis = FakeStrictRedis
+
+    def stop(self):
+        multivac.db.StrictRedis = self._orig
+
+
+def stats(samples):
+    """ Summarize a list of latencies in seconds, in milliseconds """
+    samples = sorted(samples)
+    return { 'count': len(samples),
+             'mean_ms': mean(samples) * 1000,
+             'p50_ms': median(samples) * 1000,
+             'p95_ms': samples[int(len(samples) * 0.95)] * 1000,
+             'max_ms': samples[-1] * 1000 }
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def bench_jobs(db, sizes, repeat):
+    """
+    Create jobs up to each size, measuring create_job throughput and
+    get_jobs latency at each size
+    """
+    results = { 'create_job': [], 'get_jobs': {}, 'get_jobs_page': {} }
+    created = 0
+    for size in sizes:
+        count = size - created
+        start = time.perf_counter()
+        for i in range(count):
+            # keep the fake worker registered so jobs are accepted
+            if i % 1000 == 0:
+                db.register_worker('bench', 'localhost', slots=1)
+            db.create_job('bench')
+        elapsed = time.perf_counter() - start
+        created = size
+
+        results['create_job'].append({ 'jobs': count,
+                                       'seconds': elapsed,
+                                       'jobs_per_sec': count / elapsed })
+        results['get_jobs'][size] = \
+            stats([ timed(db.get_jobs) for _ in range(repeat) ])
+        results['get_jobs_page'][size] = \
+            stats([ timed(db.get_jobs, limit=100) for _ in range(repeat) ])
+        log('%d jobs: create %.0f/s, get_jobs p50 %.1fms, '
+            'get_jobs(limit=100) p50 %.1fms' % \
+            (size, count / elapsed, results['get_jobs'][size]['p50_ms'],
+             results['get_jobs_page'][size]['p50_ms']))
+
+    return results
+
+
+def bench_logs(db, lines, repeat):
+    """
+    Measure log append rates and reads of a log with the given number
+    of lines
+    """
+    results = {}
+    line = 'y' * 80
+
+    count = min(lines, 10000)
+    elapsed = timed(lambda: [ db.append_job_log('single', line) \
+                              for _ in range(count) ])
+    results['append_job_log'] = { 'lines': count,
+                                  'lines_per_sec': count / elapsed }
+
+    batch = [ line ] * 100
+    elapsed = timed(lambda: [ db.append_job_logs({ 'batched': batch }) \
+                              for _ in range(lines // 100) ])
+    results['append_job_logs'] = { 'lines': lines,
+                                   'batch': 100,
+                                   'lines_per_sec': lines / elapsed }
+    log('append_job_log %.0f lines/s, batched %.0f lines/s' % \
+        (results['append_job_log']['lines_per_sec'],
+         results['append_job_logs']['lines_per_sec']))
+
+    reads = { 'full': {},
+              'tail_100': { 'tail': 100 },
+              'offset_middle_100': { 'offset': lines // 2, 'limit': 100 } }
+    results['get_stored_log'] = { 'lines': lines }
+    for name, kwargs in reads.items():
+        results['get_stored_log'][name] = stats(
+            [ timed(db.get_stored_log, 'batched', **kwargs) \
+              for _ in range(repeat) ])
+        log('get_stored_log %s p50 %.1fms' % \
+            (name, results['get_stored_log'][name]['p50_ms']))
+
+    return results
+
+
+def bench_e2e(db, server, runs, output_lines):
+    """
+    Run jobs through a real JobWorker, measuring time from create_job
+    to the first line of output and to completion
+    """
+    from multivac.worker import JobWorker
+
+    fd, config_path = tempfile.mkstemp(suffix='.yml')
+    with os.fdopen(fd, 'w') as of:
+        of.write(e2e_config % output_lines)
+
+    if server.port:
+        env = dict(os.environ, PYTHONPATH=repo_root)
+        proc = subprocess.Popen([ sys.executable, '-c', worker_script,
+                                  str(server.port), config_path ],
+                                stdout=sys.stderr, env=env)
+        is_alive = lambda: proc.poll() is None
+    else:
+        # fakeredis is only shared in-process, and keeps serving the
+        # worker thread after the benchmark ends
+        proc = None
+        thread = threading.Thread(target=JobWorker,
+                                  args=('localhost', server.port, config_path))
+        thread.daemon = True
+        thread.start()
+        is_alive = thread.is_alive
+
+    first_output = []
+    completed = []
+    try:
+        deadline = time.time() + worker_timeout
+        while not db.has_workers() or not db.get_action('e2e'):
+            if not is_alive():
+                raise RuntimeError('worker exited before registering')
+            if time.time() > deadline:
+                raise RuntimeError('worker not registered after %ds' % \
+                                   worker_timeout)
+            time.sleep(0.1)
+
+        for _ in range(runs):
+            start = time.perf_counter()
+            ok, job_id = db.create_job('e2e')
+            if not ok:
+                raise RuntimeError(job_id)
+
+            lines = 0
+            for entry in db.tail_log(job_id, block=1000):
+                if not lines:
+                    first_output.append(time.perf_counter() - start)
+                lines += 1
+            completed.append(time.perf_counter() - start)
+    finally:
+        # stop the worker while redis-server is still up
+        if proc:
+            proc.terminate()
+            proc.wait()
+        os.remove(config_path)
+
+    results = { 'output_lines': output_lines,
+                'first_output': stats(first_output),
+                'completed': stats(completed) }
+    log('e2e first output p50 %.1fms, completed p50 %.1fms' % \
+        (results['first_output']['p50_ms'], results['completed']['p50_ms']))
+
+    return results
+
+
+def log(msg):
+    print(msg, file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Multivac benchmarks')
+    parser.add_argument('--redis-server', default='redis-server',
+                        help='path to redis-server binary')
+    parser.add_argument('--fake', action='store_true',
+                        help='use fakeredis instead of redis-server')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma-separated job counts for get_jobs')
+    parser.add_argument('--log-lines', type=int, default=100000,
+                        help='number of lines in the large log')
+    parser.add_argument('--e2e-runs', type=int, default=20,
+                        help='number of jobs to run through a worker')
+    parser.add_argument('--e2e-lines', type=int, default=10000,
+                        help='lines of output written by each e2e job')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='repetitions of each latency measurement')
+    parser.add_argument('--output', help='write results to this file')
+    args = parser.parse_args()
+
+    sizes = sorted(int(s) for s in args.sizes.split(','))
+
+    if not args.fake and shutil.which(args.redis_server):
+        server = RedisServer(args.redis_server)
+    else:
+        log('redis-server not used, falling back to fakeredis')
+        server = FakeRedisServer()
+
+    # keep worker output out of results written to stdout
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+
+    try:
+        db = JobsDB('localhost', server.port)
+        db.load_config('bench', bench_actions, {})
+
+        results = { 'jobs': bench_jobs(db, sizes, args.repeat),
+                    'logs': bench_logs(db, args.log_lines, args.repeat) }
+
+        db.redis.flushall()
+        results['e2e'] = bench_e2e(db, server, args.e2e_runs, args.e2e_lines)
+    finally:
+        server.stop()
+        sys.stdout = stdout
+
+    report = { 'timestamp': time.time(),
+               'redis': server.version,
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'args': vars(args),
+               'results': results }
+
+    if args.output:
+        with open(args.output, 'w') as of:
+            json.dump(report, of, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,13 @@
 import os
 import json
+import socket
 from flask import Flask, Response, redirect, request, render_template
 from flask_restful import Api, abort
-from gevent.wsgi import WSGIServer
+from gevent.pywsgi import WSGIServer
 from redis import StrictRedis
 
 from multivac.version import version
+from multivac import metrics
 from multivac.db import JobsDB
 import multivac.resources as mvresources
 
@@ -13,10 +15,14 @@ resource_map = { mvresources.Jobs    : '/jobs',
                  mvresources.Groups  : '/groups',
                  mvresources.Actions : '/actions',
                  mvresources.Workers : '/workers',
+                 mvresources.Schedules : '/schedules',
+                 mvresources.JobEvents : '/events',
                  mvresources.Version : '/version',
                  mvresources.Job     : '/jobs/<string:job_id>',
                  mvresources.Logs    : '/logs/<string:job_id>',
+                 mvresources.LogEvents : '/logs/<string:job_id>/events',
                  mvresources.Cancel  : '/cancel/<string:job_id>',
+                 mvresources.Schedule : '/schedules/<string:schedule_id>',
                  mvresources.Group   : '/groups/<string:group_name>',
                  mvresources.Confirm : '/confirm/<string:job_id>',
                  mvresources.Action  : '/actions/<string:action_name>' }
@@ -35,6 +41,7 @@ class MultivacApi(object):
 
         self.app.config['DEBUG'] = debug
         self.app.config['db'] = JobsDB(redis_host, redis_port)
+        self.process = 'api-%s-%s' % (socket.getfqdn(), os.getpid())
 
         for resource, path in resource_map.items():
             self.api.add_resource(resource, path)
@@ -47,6 +54,17 @@ class MultivacApi(object):
                                    actions=db.get_actions(),
                                    version=version)
 
+        @self.app.route('/metrics', methods=['GET'])
+        def metrics_endpoint():
+            db = self.app.config['db']
+
+            # include workers and chatbots, which push their metrics
+            snapshots = db.get_pushed_metrics()
+            snapshots[self.process] = metrics.registry.snapshot()
+
+            return Response(metrics.render(snapshots),
+                            content_type='text/plain; version=0.0.4')
+
     def start_server(self, listen_port=8000):
         print('Starting Multivac API v%s' % version)
         http_server = WSGIServer(('0.0.0.0', listen_port), self.app)
@@ -1,13 +1,20 @@
 import abc
+import os
+import socket
 import logging
-from time import sleep
+from time import sleep, perf_counter
+from threading import Thread
 from concurrent.futures import ThreadPoolExecutor
 
-from multivac.db import JobsDB
+from multivac import metrics
+from multivac.db import JobsDB, job_statuses
 from multivac.util import format_time
 
 log = logging.getLogger('multivac')
 
+# number of jobs listed by the jobs command unless a limit is given
+jobs_page_size = 20
+
 
 class ChatBot(object):
     """
@@ -27,6 +34,16 @@ class ChatBot(object):
         self.executor = ThreadPoolExecutor(max_workers=20)
         log.debug('set max chatbot workers: %s' % self.executor._max_workers)
 
+        # jobs awaiting confirmation, streamed once confirmed
+        self.pending = {}  # dict of job_id:channel
+        watcher = Thread(target=self._watch_jobs)
+        watcher.daemon = True
+        watcher.start()
+
+        metrics.start_pusher(self.db,
+                             'chatbot-%s-%s' % (socket.getfqdn(), os.getpid()),
+                             collect=self._collect_metrics)
+
         self._message_worker()
 
     @abc.abstractmethod
@@ -43,17 +60,24 @@ class ChatBot(object):
         """
         raise NotImplementedError
 
-    def _print_queue(self):
-        while True:
-            print('work queue: %s' % self.executor._work_queue.qsize())
-            sleep(1)
+    def _collect_metrics(self):
+        metrics.registry.set('multivac_chatbot_work_queue',
+                             self.executor._work_queue.qsize(),
+                             help='Output handlers waiting for a thread')
+        metrics.registry.set('multivac_chatbot_pending_jobs',
+                             len(self.pending),
+                             help='Jobs awaiting confirmation before output')
 
     def _message_worker(self):
         for msg in self.messages:
+            start = perf_counter()
             try:
                 self._process_msg(*msg)
             except Exception as e:
                 log.error(e)
+            metrics.registry.observe('multivac_chatbot_message_seconds',
+                                     perf_counter() - start,
+                                     help='Time spent handling chat messages')
 
     def _process_msg(self, text, user, channel):
         """
@@ -61,10 +85,13 @@ class ChatBot(object):
         command, args = self._parse_command(text)
 
         if command in self.builtins:
-            self.reply(self.builtins[command](args), channel)
+            self.reply(self.builtins[command](args, user), channel)
             self.reply('EOF', channel)
         else:
-            ok, result = self.db.create_job(command, args=args, initiator=user)
+            # command^N sets the job priority
+            command, _, priority = command.partition('^')
+            ok, result = self.db.create_job(command, args=args, initiator=user,
+                                            priority=priority or None)
             if not ok:
                 self.reply(result, channel)
                 self.reply('EOF', channel)
@@ -79,10 +106,47 @@ class ChatBot(object):
                 self.reply('EOF', channel)
 
             if job['chatbot_stream'] != 'False':
-                self.executor.submit(self._output_handler, job_id, channel)
+                if job['status'] == 'pending':
+                    self._await_confirm(job_id, channel)
+                else:
+                    self.executor.submit(self._output_handler, job_id,
+                                         channel)
 
         return
 
+    def _await_confirm(self, job_id, channel):
+        """
+        Stream the output of a pending job once it is confirmed
+        """
+        self.pending[job_id] = channel
+
+        # the job may have changed before it was added
+        status = self.db.get_job(job_id).get('status')
+        if status != 'pending':
+            self._job_changed(job_id, status)
+
+    def _job_changed(self, job_id, status):
+        # whichever of the watcher or _await_confirm sees the change
+        # first takes the job
+        channel = self.pending.pop(job_id, None)
+        if channel and status != 'canceled':
+            self.executor.submit(self._output_handler, job_id, channel)
+
+    def _watch_jobs(self):
+        """
+        Follow job status changes, starting output handlers for jobs
+        once they are confirmed
+        """
+        after = None
+        while True:
+            try:
+                for after, event in self.db.job_events(after=after):
+                    if event['status'] != 'pending':
+                        self._job_changed(event['job'], event['status'])
+            except Exception as e:
+                log.error('error following job events: %s' % e)
+                sleep(1)
+
     @staticmethod
     def _parse_command(text):
         """ Parse message text; return command and arguments """
@@ -99,20 +163,9 @@ class ChatBot(object):
          - stream(bool): Toggle streaming output as it comes in
            vs posting when a job finishes. Default True.
         """
-        active = False
         prefix = '[%s]' % job_id[-8:]
         log.debug('output handler spawned for job %s' % job_id)
 
-        # sleep on jobs awaiting confirmation
-        while not active:
-            job = self.db.get_job(job_id)
-            if job['status'] == 'canceled':
-                return
-            if job['status'] != 'pending':
-                active = True
-            else:
-                sleep(1)
-
         if stream:
             for line in self.db.get_log(job_id, timestamp=False):
                 self.reply(prefix + line, channel)
@@ -128,18 +181,15 @@ class ChatBot(object):
     # Builtin command methods
     ######
 
-    def _confirm(self, arg):
+    def _confirm(self, arg, user=None):
         """ Confirm a pending job """
-        job = self.db.get_job(arg)
-        if not job:
-            return 'no such job id'
-        if job['status'] != 'pending':
-            return 'job not awaiting confirm'
+        ok, result = self.db.confirm_job(arg)
+        if not ok:
+            return result
 
-        self.db.update_job(arg, 'status', 'ready')
         return 'job confirmed'
 
-    def _cancel(self, arg):
+    def _cancel(self, arg, user=None):
         """ Cancel a pending job """
         job = self.db.get_job(arg)
         if not job:
@@ -151,21 +201,43 @@ class ChatBot(object):
 
         return 'job %s canceled' % job['id']
 
-    def _workers(self, arg):
+    def _workers(self, arg, user=None):
         """ Show registered job workers """
         workers = self.db.get_workers()
         if not workers:
             return 'no registered workers'
         else:
-            return [('%s(%s)' % (w['name'], w['host'])) for w in workers]
-
-    def _jobs(self, arg):
-        """ Show jobs by currrent state """
-        subcommands = ['pending', 'running', 'completed', 'all']
-        if arg not in subcommands:
-            return 'argument must be one of %s' % ','.join(subcommands)
-
-        jobs = self.db.get_jobs(status=arg)
+            return [ '%s(%s) %s/%s jobs, load %s' % \
+                     (w['name'], w['host'], w.get('running', '?'),
+                      w.get('slots', '?'), w.get('load', '?')) \
+                     for w in workers ]
+
+    def _jobs(self, args, user=None):
+        """ Show jobs [status] [action=X] [limit=N] [before=ID] [after=ID] """
+        subcommands = list(job_statuses) + ['all']
+        words = args.split()
+
+        status = 'all'
+        if words and '=' not in words[0]:
+            status = words.pop(0)
+            if status not in subcommands:
+                return 'argument must be one of %s' % ','.join(subcommands)
+
+        opts = { 'limit': jobs_page_size }
+        for word in words:
+            key, _, value = word.partition('=')
+            if key not in ('action', 'limit', 'before', 'after') or not value:
+                return 'invalid option %s' % word
+            if key == 'limit':
+                if not value.isdigit() or int(value) < 1:
+                    return 'invalid option %s' % word
+                value = int(value)
+            opts[key] = value
+
+        if 'before' in opts and 'after' in opts:
+            return 'only one of before or after is allowed'
+
+        jobs = self.db.get_jobs(status=status, **opts)
 
         if not jobs:
             return 'no matching jobs found'
@@ -178,21 +250,32 @@ class ChatBot(object):
 
         return formatted
 
-    def _logs(self, args):
-        """ Show logs for a given job id """
-        if not self.db.get_job(args):
+    def _logs(self, args, user=None):
+        """ Show logs for a given job id [tail=N] [offset=N] [limit=N] """
+        words = args.split(' ')
+        job_id = words.pop(0)
+
+        opts = {}
+        for word in words:
+            key, _, value = word.partition('=')
+            if key not in ('tail', 'offset', 'limit') or not value.isdigit():
+                return 'invalid option %s' % word
+            opts[key] = int(value)
+
+        if not self.db.get_job(job_id):
             return 'no matching jobs found'
 
-        return self.db.get_stored_log(args)
+        return self.db.get_stored_log(job_id, **opts)
 
-    def _help(self, args):
+    def _help(self, args, user=None):
         """ Show this help dialog """
         builtin_cmds = ['Builtin commands:']
         for cmd, func in sorted(self.builtins.items()):
             builtin_cmds.append('  [ %s ]%s' % (cmd, func.__doc__))
 
-        action_cmds = ['Action commands:']
-        for cmd in sorted([ a['name'] for a in self.db.get_actions() ]):
+        action_cmds = ['Action commands (append ^N to set priority):']
+        actions = self.db.get_user_actions(user)
+        for cmd in sorted([ a['name'] for a in actions ]):
             action_cmds.append('  [ %s ]' % cmd)
 
         return builtin_cmds + action_cmds
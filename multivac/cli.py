@@ -11,7 +11,8 @@ subcommands = ['worker', 'slackbot', 'api', 'console']
 # defaults
 config = { 'slack_token': None,
            'api_listen_port': 8000,
-           'redis': '127.0.0.1:6379' }
+           'redis': '127.0.0.1:6379',
+           'redis_max_connections': None }
 
 
 def main():
@@ -28,6 +29,12 @@ def main():
 
     args = parser.parse_args()
 
+    if args.subcommand == 'api':
+        # make redis calls and threads cooperative with the gevent server;
+        # must happen before redis is imported
+        from gevent import monkey
+        monkey.patch_all()
+
     if args.d:
         debug = True
         logging.basicConfig(level=logging.DEBUG)
@@ -49,6 +56,9 @@ def main():
         redis_host = config['redis']
         redis_port = 6379
 
+    from multivac.db import configure_pool
+    configure_pool(max_connections=config['redis_max_connections'])
+
     if args.subcommand == 'api':
         from multivac.api import MultivacApi
         api = MultivacApi(redis_host, redis_port, debug=debug)
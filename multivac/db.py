@@ -2,28 +2,124 @@ import json
 import logging
 import redis.exceptions
 
-from redis import StrictRedis
+from redis import StrictRedis, ConnectionPool, BlockingConnectionPool
 from datetime import datetime
 from uuid import uuid4
-from time import sleep
+from time import sleep, time
+from math import ceil
+from queue import Empty
+from threading import Thread, Lock
 
-from multivac.util import unix_time
+from multivac.util import unix_time, cron_next
+from multivac import scripts
+from multivac.metrics import timed
+from multivac.logrouter import LogRouter, overflow
 
 log = logging.getLogger('multivac')
 
+# seconds a worker remains registered after its last heartbeat
+worker_ttl = 15
+
+# number of queued jobs a claim reads at a time looking for one it may run
+claim_depth = 100
+
+# maximum pending wakeups for idle workers
+max_signals = 100
+
+# log entries buffered per reader before it must catch up from redis
+log_buffer_lines = 1000
+
+# approximate number of job status events kept for readers to resume from
+max_events = 10000
+
+# seconds a ready job must wait to be dispatched before a job of one
+# higher priority queued after it
+priority_aging = 60
+
+# seconds a job awaits confirmation before it is canceled, unless set
+# by its action
+confirm_timeout = 300
+
+# seconds a local copy of actions and groups is used before checking it
+# against the config change counter, in case a notification was missed
+config_check_interval = 5
+
+# layout of the job indexes; existing jobs are reindexed when it changes
+index_version = '5'
+
+db_metric = 'multivac_db_call_seconds'
+db_metric_help = 'Calls to JobsDB methods and their duration'
+
+job_statuses = ('pending', 'ready', 'running', 'completed', 'canceled')
+finished_statuses = ('completed', 'canceled')
+
+# connection pools and log routers shared by all JobsDB instances in this
+# process, by redis host and port
+_pools = {}
+_routers = {}
+_pools_lock = Lock()
+_pool_options = { 'max_connections': None, 'timeout': 20 }
+
+
+def configure_pool(max_connections=None, timeout=20):
+    """
+    Set options for the connection pools of this process. Must be called
+    before any JobsDB is created
+    params:
+     - max_connections(int): Maximum connections per pool, after which
+       callers wait for a free connection. default unlimited.
+     - timeout(int): Seconds to wait for a free connection
+    """
+    _pool_options.update(max_connections=max_connections, timeout=timeout)
+
+
+def _get_pool(host, port):
+    with _pools_lock:
+        if (host, port) not in _pools:
+            if _pool_options['max_connections']:
+                pool = BlockingConnectionPool(host=host, port=port,
+                                              decode_responses=True,
+                                              **_pool_options)
+            else:
+                pool = ConnectionPool(host=host, port=port,
+                                      decode_responses=True)
+            _pools[(host, port)] = pool
+        return _pools[(host, port)]
+
 class JobsDB(object):
     prefix = { 'job' : 'multivac_job',
                'log' : 'multivac_log',
+               'index' : 'multivac_index',
+               'queue' : 'multivac_queue',
                'group' : 'multivac_group',
+               'config' : 'multivac_config',
                'action' : 'multivac_action',
-               'worker' : 'multivac_worker' }
+               'worker' : 'multivac_worker',
+               'metrics' : 'multivac_metrics',
+               'schedule' : 'multivac_schedule' }
 
     def __init__(self, redis_host, redis_port):
+        self._pool_key = (redis_host, redis_port)
         self.redis = StrictRedis(
-            host=redis_host,
-            port=redis_port,
-            decode_responses=True)
-        self.subs = {}
+            connection_pool=_get_pool(redis_host, redis_port))
+
+        self._create = self.redis.register_script(scripts.create_job)
+        self._set_status = self.redis.register_script(scripts.set_status)
+        self._claim = self.redis.register_script(scripts.claim_job)
+        self._requeue = self.redis.register_script(scripts.requeue_job)
+        self._release_slot = self.redis.register_script(scripts.release_slot)
+        self._claim_schedule = self.redis.register_script(
+            scripts.claim_schedule)
+        self._acquire_lock = self.redis.register_script(scripts.acquire_lock)
+
+        # local copy of actions and groups, cleared on config change
+        self._cache = None
+        self._cache_gen = 0
+        self._cache_lock = Lock()
+        self._config_sub = None
+
+        # last state registered by workers of this process
+        self._registered = {}
 
         # TODO: add connection test with r.config_get('port')
 
@@ -31,101 +127,557 @@ class JobsDB(object):
     # Job Methods
     #######
 
-    def create_job(self, action_name, args=None, initiator=None):
+    @timed(db_metric, db_metric_help)
+    def create_job(self, action_name, args=None, initiator=None,
+                   priority=None):
         """
-        Create a new job with unique ID and subscribe to log channel
+        Create a new job with unique ID
         params:
          - action_name(str): Name of the action this job uses
          - args(str): Optional space-delimited series of arguments to be
            appended to the job command
          - initiator(str): Optional name of the user who initiated this job
+         - priority(int): Optional priority overriding the action default.
+           Higher priority jobs are dispatched first
         """
-        job = self.get_action(action_name)
+        ok, result = self.create_jobs(action_name, [ args ],
+                                      initiator=initiator,
+                                      priority=priority)
+        if not ok:
+            return (False, result)
 
-        if not job:
+        if not result[0]:
+            return (False, 'too many queued jobs for action %s' % action_name)
+
+        return (True, result[0])
+
+    @timed(db_metric, db_metric_help)
+    def create_jobs(self, action_name, args_list, initiator=None,
+                    priority=None):
+        """
+        Create any number of jobs for one action in a single round trip,
+        checking the action and permissions once. Returns a list of job ids
+        in the order given, with None in place of any job rejected by the
+        action's queue limit
+        params:
+         - action_name(str): Name of the action the jobs use
+         - args_list(list): Arguments for each job, as for create_job
+         - initiator(str): Optional name of the user who initiated the jobs
+         - priority(int): Optional priority overriding the action default
+        """
+        action = self.get_action(action_name)
+
+        if not action:
             return (False, 'no such action')
 
         #check that user has privilege for this command
-        if not self.check_user(initiator, job['allow_groups'].split(',')):
+        if not self.check_permission(initiator, action):
             log.debug('action denied: %s for user %s' % \
                      (action_name, initiator))
             return (False, 'Invalid user command')
 
-        if len(self.get_workers()) == 0:
-            return (False, 'No workers available!')
+        return self._create_jobs(action, args_list, initiator, priority)
 
-        job['id'] = str(uuid4().hex)
-        job['args'] = args
-        job['created'] = unix_time(datetime.utcnow())
+    def _create_jobs(self, action, args_list, initiator=None, priority=None):
+        """
+        Create jobs for an action without checking permissions, as for
+        create_jobs
+        """
+        action_name = action['name']
+        if priority is None:
+            priority = action.get('priority') or 0
+        try:
+            priority = int(priority)
+        except ValueError:
+            return (False, 'priority must be an integer')
+
+        if not self.has_workers():
+            return (False, 'No workers available!')
 
-        if job['confirm_required'] == "True":
-            job['status'] = 'pending'
+        created = unix_time(datetime.utcnow())
+        if action['confirm_required'] == "True":
+            status = 'pending'
         else:
-            job['status'] = 'ready'
+            status = 'ready'
+
+        # write job hashes and index entries atomically per job, subject
+        # to the action's queue limit
+        keys = [ None,
+                 self._key('index', 'created'),
+                 self._status_key(status),
+                 self._key('queue', 'dispatch'),
+                 self._key('index', 'queued:' + action_name),
+                 self._key('queue', 'signal'),
+                 self._serial_key('jobs'),
+                 self._action_key(action_name),
+                 self._action_key(action_name, status),
+                 self._key('index', 'confirm_deadline'),
+                 self._key('queue', 'events') ]
+
+        pipe = self.redis.pipeline(transaction=False)
+        job_ids = []
+        for args in args_list:
+            job = dict(action)
+            job['id'] = str(uuid4().hex)
+            job['args'] = args or ''
+            job['created'] = created
+            job['status'] = status
+            job['priority'] = priority
+            if status == 'ready':
+                job['queued'] = time()
 
-        self._subscribe_to_log(job['id'])
+            if initiator:
+                pipe.xadd(self._key('log', job['id']),
+                          {'line': 'Job initiated by %s' % initiator})
 
+            keys[0] = self._key('job', job['id'])
+            script_args = [ job['id'], created, status,
+                            job.get('max_queued', ''), max_signals,
+                            self._dispatch_score(job),
+                            self._confirm_deadline(job),
+                            max_events ]
+            for field, value in job.items():
+                script_args += [ field, value ]
+            self._create(keys=keys, args=script_args, client=pipe)
+            job_ids.append(job['id'])
+
+        results = pipe.execute()
         if initiator:
-            self.append_job_log(job['id'], 'Job initiated by %s' % initiator)
+            results = results[1::2]
 
-        self.redis.hmset(self._key('job', job['id']), job)
+        rejected = [ j for j,ok in zip(job_ids, results) if not ok ]
+        if rejected:
+            self.redis.delete(*[ self._key('log', j) for j in rejected ])
 
-        return (True, job['id'])
+        return (True, [ j if ok else None for j,ok in zip(job_ids, results) ])
 
+    @timed(db_metric, db_metric_help)
     def cancel_job(self, job_id):
         """ Cancel and cleanup a pending job by ID """
-        job = self.get_job(job_id)
-        if job['status'] != 'pending':
-            return (False, 'Cannot cancel job in %s state' % job['status'])
+        ok, result = self._update_status(job_id, 'canceled', expect='pending')
+        if not ok:
+            if result == 'invalid state':
+                job = self.get_job(job_id)
+                return (False, 'Cannot cancel job in %s state' % job['status'])
+            return (False, result)
 
         self.cleanup_job(job_id, canceled=True)
 
         return (True, '')
 
+    @timed(db_metric, db_metric_help)
+    def cancel_unconfirmed_jobs(self, now=None, batch=1000):
+        """
+        Cancel pending jobs not confirmed by their deadline. Each job is
+        claimed atomically, so it is canceled once however many workers
+        call this. Returns the ids of canceled jobs
+        params:
+         - batch(int): Maximum number of jobs to cancel per call
+        """
+        index = self._key('index', 'confirm_deadline')
+        expired = self.redis.zrangebyscore(index, '-inf', now or time(),
+                                           start=0, num=batch)
+
+        canceled = []
+        for job_id in expired:
+            if not self.redis.zrem(index, job_id):
+                continue
+            ok, _ = self.cancel_job(job_id)
+            if ok:
+                canceled.append(job_id)
+
+        return canceled
+
+    @timed(db_metric, db_metric_help)
+    def confirm_job(self, job_id):
+        """ Mark a pending job as ready and queue it for a worker """
+        ok, result = self._update_status(job_id, 'ready', expect='pending',
+                                         enqueue=True)
+        if not ok:
+            if result == 'invalid state':
+                return (False, 'job not awaiting confirm')
+            return (False, result)
+
+        return (True, '')
+
+    @timed(db_metric, db_metric_help)
     def update_job(self, job_id, field, value):
         """ Update an arbitrary field for a job """
-        self.redis.hset(self._key('job', job_id), field, value)
+        if field == 'status':
+            return self._update_status(job_id, value)
+
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key('job', job_id), field, value)
+        pipe.incr(self._serial_key('jobs'))
+        pipe.execute()
         return (True,)
 
+    def _update_status(self, job_id, status, expect=None, enqueue=False):
+        """
+        Set the status of a job, moving it to the matching status index
+        params:
+         - expect(str): Only update if the job currently has this status
+         - enqueue(bool): Also push the job onto the ready queue
+        """
+        if status not in job_statuses:
+            return (False, 'invalid job status %s' % status)
+
+        keys = [ self._key('job', job_id),
+                 self._status_key(status),
+                 self._key('queue', 'dispatch'),
+                 self._key('index', 'finished'),
+                 self._key('queue', 'signal'),
+                 self._serial_key('jobs'),
+                 self._key('queue', 'events'),
+                 self._key('index', 'confirm_deadline') ]
+        keys += [ self._status_key(s) for s in job_statuses ]
+        args = [ job_id, status, expect or '', '1' if enqueue else '0',
+                 int(time()) if status in finished_statuses else '',
+                 self._key('index', ''), max_signals, time(), priority_aging,
+                 max_events, self._key('action', '') ]
+
+        result = self._set_status(keys=keys, args=args)
+        if result == 0:
+            return (False, 'no such job id')
+        if result == -1:
+            return (False, 'invalid state')
+
+        return (True, '')
+
+    @timed(db_metric, db_metric_help)
+    def claim_job(self, worker_name, timeout=1):
+        """
+        Claim the oldest ready job whose action is below its concurrency
+        limit, atomically moving it to this worker's processing list.
+        Blocks until a job is queued or a running job finishes if none
+        can be claimed. Returns the job dict or None on timeout
+        params:
+         - worker_name(str): Name of the claiming worker
+         - timeout(int): Seconds to wait for a job
+        """
+        keys = [ self._key('queue', 'dispatch'),
+                 self._key('queue', 'processing:' + worker_name) ]
+        args = [ claim_depth,
+                 self._key('job', ''),
+                 self._key('action', ''),
+                 self._key('index', '') ]
+
+        job_id = self._claim(keys=keys, args=args)
+        if not job_id:
+            if not self.redis.blpop(self._key('queue', 'signal'), timeout):
+                return None
+            job_id = self._claim(keys=keys, args=args)
+            if not job_id:
+                return None
+
+        job = self.get_job(job_id)
+        if job.get('status') == 'ready':
+            return job
+
+        # job was recovered from a lost worker after it had started;
+        # never run it twice
+        log.warn('discarding claimed job %s in state %s' % \
+                 (job_id, job.get('status')))
+        self.release_job(worker_name, job_id)
+        if job.get('status') == 'running':
+            self.append_job_log(job_id, 'Job lost by its worker')
+            self.cleanup_job(job_id)
+        elif job.get('name'):
+            self._release_slot(keys=[ self._key('queue', 'dispatch'),
+                                      self._key('queue', 'signal') ],
+                               args=[ job_id, job['name'],
+                                      self._key('index', ''),
+                                      self._key('action', ''),
+                                      max_signals ])
+
+        return None
+
+    @timed(db_metric, db_metric_help)
+    def release_job(self, worker_name, job_id):
+        """ Remove a finished job from a worker's processing list """
+        processing = self._key('queue', 'processing:' + worker_name)
+        self.redis.lrem(processing, 0, job_id)
+
+    @timed(db_metric, db_metric_help)
+    def requeue_orphaned_jobs(self):
+        """
+        Return jobs claimed by workers that are no longer registered
+        to the front of the ready queue
+        """
+        registry = self._key('index', 'processing')
+        names = list(self.redis.smembers(registry))
+
+        pipe = self.redis.pipeline(transaction=False)
+        for name in names:
+            pipe.exists(self._key('worker', name))
+        lost = [ n for n,live in zip(names, pipe.execute()) if not live ]
+
+        for name in lost:
+            processing = self._key('queue', 'processing:' + name)
+            keys = [ processing, self._key('queue', 'dispatch') ]
+            args = [ self._key('job', ''), self._key('index', ''),
+                     self._key('action', '') ]
+            while True:
+                result = self._requeue(keys=keys, args=args)
+                if not result:
+                    break
+                job_id, requeued = result
+                if requeued:
+                    log.warn('requeued job %s from lost worker %s' % \
+                             (job_id, name))
+                else:
+                    log.info('dropped finished job %s from lost worker %s' % \
+                             (job_id, name))
+            # a worker that returns registers itself again
+            self.redis.srem(registry, name)
+
+    @timed(db_metric, db_metric_help)
     def cleanup_job(self, job_id, canceled=False):
         """
-        Cleanup log subscriptions for a given job id and mark completed
+        End the log stream for a given job id and mark completed
         params:
          - canceled(bool): If True, mark job as canceled instead of completed
         """
-        logkey = self._key('log', job_id)
-
         # send EOF signal to streaming clients
-        self.redis.publish(logkey, 'EOF')
-
-        if job_id in self.subs:
-            self.subs[job_id].unsubscribe()
-            del self.subs[job_id]
-            log.debug('Unsubscribed from log channel: %s' % logkey)
+        self.redis.xadd(self._key('log', job_id), {'eof': '1'})
 
         if canceled:
             self.update_job(job_id, 'status', 'canceled')
         else:
             self.update_job(job_id, 'status', 'completed')
 
+    @timed(db_metric, db_metric_help)
     def get_job(self, job_id):
         """
         Return single job dict given a job id
         """
         return self.redis.hgetall(self._key('job', job_id))
 
-    def get_jobs(self, status='all'):
+    @timed(db_metric, db_metric_help)
+    def get_jobs(self, status='all', action=None, limit=None, before=None,
+                 after=None):
         """
-        Return all jobs dicts, optionally filtered by status
-        via the 'status' param
+        Return job dicts newest first, optionally filtered and paged. Pages
+        are read from ordered indexes, so cost does not grow with the total
+        number of jobs
+        params:
+         - status(str): Only return jobs with this status. default all.
+         - action(str): Only return jobs of this action
+         - limit(int): Maximum number of jobs to return. default unlimited.
+         - before(str): Only return jobs created before this job id
+         - after(str): Only return jobs created after this job id
         """
-        jobs = [self.redis.hgetall(k) for k in
-                self.redis.keys(pattern=self._key('job', '*'))]
-        if status != 'all':
-            return [j for j in jobs if j['status'] == status]
+        if status != 'all' and status not in job_statuses:
+            return []
+
+        if action:
+            key = self._action_key(action, None if status == 'all' else status)
+        elif status == 'all':
+            key = self._key('index', 'created')
         else:
-            return [j for j in jobs]
+            key = self._status_key(status)
 
+        if before or after:
+            job_ids = self._page(key, before or after, limit,
+                                 older=bool(before))
+        else:
+            job_ids = self.redis.zrevrange(key, 0, (limit or 0) - 1)
+
+        return self._get_hashes([ self._key('job', j) for j in job_ids ])
+
+    def _page(self, key, cursor, limit=None, older=True, batch=1000):
+        """
+        Return ids from a job index ordered by creation time, newest first,
+        for jobs next to a cursor job in the given direction. Jobs created in
+        the same second are ordered by id.
+        """
+        score = self.redis.zscore(self._key('index', 'created'), cursor)
+        if score is None:
+            created = self.redis.hget(self._key('job', cursor), 'created')
+            if created is None:
+                return []
+            score = float(created)
+
+        job_ids = []
+        offset = 0
+        while limit is None or len(job_ids) < limit:
+            if older:
+                entries = self.redis.zrevrangebyscore(key, score, '-inf',
+                                                      start=offset, num=batch,
+                                                      withscores=True)
+                matches = [ j for j,s in entries if s < score or j < cursor ]
+            else:
+                entries = self.redis.zrangebyscore(key, score, '+inf',
+                                                   start=offset, num=batch,
+                                                   withscores=True)
+                matches = [ j for j,s in entries if s > score or j > cursor ]
+            if not entries:
+                break
+            offset += len(entries)
+            job_ids += matches
+
+        job_ids = job_ids[:limit]
+        return job_ids if older else list(reversed(job_ids))
+
+    def index_jobs(self):
+        """
+        Build the job indexes from stored job hashes if they were created
+        with an older layout, e.g. for jobs created by an older version
+        """
+        version_key = self._key('index', 'version')
+        if self.redis.get(version_key) == index_version:
+            return
+
+        pipe = self.redis.pipeline()
+
+        # register processing lists of workers from older versions, and
+        # leave the jobs they claimed out of the ready queue
+        claimed = set()
+        pattern = self._key('queue', 'processing:*')
+        for processing in self.redis.scan_iter(match=pattern):
+            pipe.sadd(self._key('index', 'processing'),
+                      processing.split(':', 2)[2])
+            claimed.update(self.redis.lrange(processing, 0, -1))
+
+        count = 0
+        for key in self.redis.scan_iter(match=self._key('job', '*')):
+            job_id, status, created, name, timeout, queued, priority = \
+                    self.redis.hmget(key, 'id', 'status', 'created', 'name',
+                                     'confirm_timeout', 'queued', 'priority')
+            if not job_id or status not in job_statuses:
+                continue
+            pipe.zadd(self._key('index', 'created'), {job_id: created})
+            pipe.zadd(self._status_key(status), {job_id: created})
+            pipe.zadd(self._action_key(name), {job_id: created})
+            pipe.zadd(self._action_key(name, status), {job_id: created})
+            if status in finished_statuses:
+                pipe.zadd(self._key('index', 'finished'), {job_id: created})
+            job = { 'created': created,
+                    'confirm_timeout': timeout,
+                    'queued': queued,
+                    'priority': priority }
+            if status == 'pending':
+                pipe.zadd(self._key('index', 'confirm_deadline'),
+                          {job_id: self._confirm_deadline(job)})
+            if status in ('pending', 'ready') and job_id not in claimed:
+                pipe.sadd(self._key('index', 'queued:' + name), job_id)
+            if status == 'ready' and job_id not in claimed:
+                pipe.zadd(self._key('queue', 'dispatch'),
+                          {job_id: self._dispatch_score(job)})
+            if self.redis.type(self._key('log', job_id)) == 'list':
+                self._convert_log(job_id, eof=status in finished_statuses)
+            count += 1
+
+        # ready jobs are queued above; drop the list used by older versions
+        pipe.delete(self._key('queue', 'ready'))
+
+        pipe.set(version_key, index_version)
+        pipe.execute()
+        log.info('indexed %s existing jobs' % count)
+
+    def _convert_log(self, job_id, eof=False):
+        """
+        Rewrite a job log stored as a list by older versions as a stream,
+        keeping the time each line was written
+        params:
+         - eof(bool): end the stream, for jobs that have finished
+        """
+        key = self._key('log', job_id)
+        tmp_key = self._key('log', job_id + ':convert')
+
+        pipe = self.redis.pipeline()
+        pipe.delete(tmp_key)
+        last = (0, 0)
+        for jsonlog in reversed(self.redis.lrange(key, 0, -1)):
+            ts, line = json.loads(jsonlog)
+            secs = unix_time(datetime.strptime(ts, '%a %b %d %H:%M:%S %Y'))
+            # ids must increase, so lines written in the same second
+            # are numbered in order
+            last = max((secs * 1000, 0), (last[0], last[1] + 1))
+            pipe.xadd(tmp_key, {'line': line}, id='%d-%d' % last)
+        if eof:
+            pipe.xadd(tmp_key, {'eof': '1'})
+        if len(pipe) > 1:
+            pipe.rename(tmp_key, key)
+        else:
+            pipe.delete(key)
+        pipe.execute()
+
+    @timed(db_metric, db_metric_help)
+    def expire_jobs(self, ttl=None, max_jobs=None, batch=1000,
+                    max_passes=None):
+        """
+        Delete finished jobs and their logs according to retention limits,
+        in batches until none exceed them. Returns the number of jobs deleted
+        params:
+         - ttl(int): Seconds to keep jobs after they have finished
+         - max_jobs(int): Maximum number of jobs to keep in total. Only
+           finished jobs are deleted, oldest first
+         - batch(int): Maximum number of jobs to delete per pass
+         - max_passes(int): Optional maximum number of passes per call,
+           leaving any remaining jobs to later calls
+        """
+        finished = self._key('index', 'finished')
+        deleted = 0
+        passes = 0
+
+        while not max_passes or passes < max_passes:
+            passes += 1
+            expired = set()
+
+            if ttl:
+                cutoff = int(time()) - ttl
+                expired.update(self.redis.zrangebyscore(finished, '-inf',
+                                                        cutoff, start=0,
+                                                        num=batch))
+            if max_jobs:
+                total = self.redis.zcard(self._key('index', 'created'))
+                excess = min(total - len(expired) - max_jobs, batch)
+                if excess > 0:
+                    # oldest finished jobs, including any already expired
+                    expired.update(self.redis.zrange(finished, 0,
+                                                     len(expired) + excess - 1))
+
+            if expired:
+                self._delete_jobs(expired)
+                deleted += len(expired)
+
+            # a short pass means nothing is left over the limits
+            if len(expired) < batch:
+                break
+
+        if deleted:
+            log.info('expired %s finished jobs' % deleted)
+
+        return deleted
+
+    def _delete_jobs(self, job_ids):
+        """
+        Delete job hashes and logs, removing them from all indexes
+        """
+        indexes = [ self._key('index', 'created'),
+                    self._key('index', 'finished'),
+                    self._key('index', 'confirm_deadline') ]
+        indexes += [ self._status_key(s) for s in job_statuses ]
+
+        job_ids = list(job_ids)
+        pipe = self.redis.pipeline(transaction=False)
+        for job_id in job_ids:
+            pipe.hmget(self._key('job', job_id), 'name', 'status')
+        jobs = pipe.execute()
+
+        pipe = self.redis.pipeline()
+        for job_id, (name, status) in zip(job_ids, jobs):
+            pipe.delete(self._key('job', job_id), self._key('log', job_id))
+            if name:
+                pipe.zrem(self._action_key(name), job_id)
+                pipe.zrem(self._action_key(name, status), job_id)
+        for idx in indexes:
+            pipe.zrem(idx, *job_ids)
+        pipe.incr(self._serial_key('jobs'))
+        pipe.execute()
+
+    @timed(db_metric, db_metric_help)
     def get_log(self, job_id, timestamp=True):
         """
         Return stored log for a given job id if finished,
@@ -145,48 +697,210 @@ class JobsDB(object):
             log.debug('fetching logstream for running job')
             return self.get_logstream(job_id, timestamp=timestamp)
 
-    def get_logstream(self, job_id, timestamp=True):
+    def get_logstream(self, job_id, timestamp=True, after='0',
+                      entry_ids=False):
         """
         Returns a generator object to stream all job output
         until the job has completed
         params:
          - timestamp(bool): prefix lines with timestamp. default True.
+         - after(str): only return output following this log entry id
+         - entry_ids(bool): yield (entry id, line) tuples. default False.
+        """
+        for entry_id, fields in self.tail_log(job_id, after=after):
+            line = self._read_logentry(entry_id, fields, append_ts=timestamp)
+            yield (entry_id, line) if entry_ids else line
+
+    def tail_log(self, job_id, after='0', block=5000):
+        """
+        Generator yielding (entry id, fields) tuples for all log entries
+        following a given entry id, blocking for new output until the
+        job has completed. Usable from any process.
+        params:
+         - after(str): log entry id to resume from. default from start.
+         - block(int): milliseconds to wait for output before checking
+           whether the job is still active
         """
         key = self._key('log', job_id)
-        sub = self.subs[job_id]
+        router = self._log_router()
+        queue = router.subscribe(key, after, limit=log_buffer_lines)
+        try:
+            while True:
+                try:
+                    entry = queue.get(timeout=block / 1000.0)
+                except Empty:
+                    # no output within block period; stop following a job
+                    # that ended without writing EOF
+                    job = self.get_job(job_id)
+                    if job.get('status') not in ('pending', 'ready',
+                                                 'running'):
+                        return
+                    continue
 
-        for msg in sub.listen():
-            if str(msg['data']) == 'EOF':
-                break
-            else:
-                yield self._read_jsonlog(msg['data'], append_ts=timestamp)
+                if entry is None:
+                    return
+                if entry is overflow:
+                    # fell behind; read on from redis where we left off
+                    queue = router.subscribe(key, after,
+                                             limit=log_buffer_lines)
+                    continue
+                after = entry[0]
+                yield entry
+        finally:
+            router.unsubscribe(key, queue)
 
-    def get_stored_log(self, job_id, timestamp=True):
+    def job_events(self, after=None, job_id=None, idle=None):
+        """
+        Generator yielding (event id, event) tuples for job status changes
+        following a given event id, where each event is a dict of the job
+        id, action name and new status. Usable from any process.
+        params:
+         - after(str): event id to resume from. default from now.
+         - job_id(str): only yield events of this job
+         - idle(float): yield None after this many seconds without an
+           event, e.g. to keep a connection open. default never.
+        """
+        key = self._key('queue', 'events')
+        if after is None:
+            entries = self.redis.xrevrange(key, '+', '-', count=1)
+            after = entries[0][0] if entries else '0'
+
+        router = self._log_router()
+        queue = router.subscribe(key, after, limit=log_buffer_lines)
+        try:
+            while True:
+                try:
+                    entry = queue.get(timeout=idle)
+                except Empty:
+                    yield None
+                    continue
+
+                if entry is overflow:
+                    # fell behind; read on from redis where we left off
+                    queue = router.subscribe(key, after,
+                                             limit=log_buffer_lines)
+                    continue
+                after = entry[0]
+                if job_id is None or entry[1]['job'] == job_id:
+                    yield entry
+        finally:
+            router.unsubscribe(key, queue)
+
+    def _log_router(self):
+        """
+        Return the log router shared by this process, starting it if needed
+        """
+        with _pools_lock:
+            if self._pool_key not in _routers:
+                wake_key = self._key('queue', 'router:' + uuid4().hex)
+                _routers[self._pool_key] = LogRouter(self.redis, wake_key)
+            return _routers[self._pool_key]
+
+    @timed(db_metric, db_metric_help)
+    def get_stored_log(self, job_id, timestamp=True, offset=0, limit=None,
+                       tail=None):
         """
         Return the stored output of a given job id
         params:
          - timestamp(bool): prefix lines with timestamp. default True.
+         - offset(int): number of lines to skip from the start
+         - limit(int): maximum number of lines to return
+         - tail(int): return only the last N lines, ignoring offset
         """
-        logs = self.redis.lrange(self._key('log', job_id), 0, -1)
-        return [ self._read_jsonlog(l,append_ts=timestamp) for \
-                 l in reversed(logs) ]
+        key = self._key('log', job_id)
+        try:
+            if tail is not None:
+                entries = self._tail_entries(key, tail)
+            else:
+                entries = self._range_entries(key, offset, limit)
+        except redis.exceptions.ResponseError:
+            # logs stored as a list by older versions
+            logs = self.redis.lrange(key, 0, -1)
+            lines = [ self._read_jsonlog(l,append_ts=timestamp) for \
+                      l in reversed(logs) ]
+            if tail is not None:
+                return lines[-tail:] if tail else []
+            return lines[offset:offset + limit if limit else None]
+
+        return [ self._read_logentry(i, f, append_ts=timestamp) for \
+                 i,f in entries ]
+
+    def _tail_entries(self, key, count):
+        """ Return the last count log entries of a stream in order """
+        if count <= 0:
+            return []
+        # fetch one extra in case the last entry is EOF
+        entries = self.redis.xrevrange(key, '+', '-', count=count + 1)
+        entries = [ e for e in entries if 'eof' not in e[1] ][:count]
+        return list(reversed(entries))
+
+    def _range_entries(self, key, offset=0, limit=None, chunk=1000):
+        """
+        Return log entries of a stream starting at a line offset, reading
+        in chunks so that skipping lines does not load them all at once
+        """
+        entries = []
+        start = '-'
+        while limit is None or len(entries) < limit:
+            count = chunk
+            if limit is not None:
+                count = min(chunk, offset + limit - len(entries))
+            batch = self.redis.xrange(key, start, '+', count=count)
+            if not batch:
+                break
+            start = self._next_entry_id(batch[-1][0])
+
+            batch = [ e for e in batch if 'eof' not in e[1] ]
+            if offset >= len(batch):
+                offset -= len(batch)
+                continue
+            entries += batch[offset:]
+            offset = 0
+
+        return entries[:limit]
+
+    @staticmethod
+    def _next_entry_id(entry_id):
+        """ Return the smallest stream id following the given id """
+        ms, seq = entry_id.split('-')
+        return '%s-%d' % (ms, int(seq) + 1)
 
     def append_job_log(self, job_id, text):
         """
-        Append a line of job output to a redis list and
-        publish to relevant channel
+        Append one or more lines of job output to the job's log stream
         """
-        key = self._key('log', job_id)
+        self.append_job_logs({ job_id: text.splitlines() })
 
-        #split up the line if carriage returns, newlines
-        if len(text.splitlines()) > 1:
-            for line in text.splitlines():
-                self.append_job_log(job_id, line)
-        else:
-            if not text.isspace(): #don't keep empty lines
-                logjson = self._jsonlog(text)
-                self.redis.publish(key, logjson)
-                self.redis.lpush(key, logjson)
+    @timed(db_metric, db_metric_help)
+    def append_job_logs(self, logs, max_lines=None):
+        """
+        Append lines of output for any number of jobs in a single
+        round trip
+        params:
+         - logs(dict): mapping of job id to a list of lines
+         - max_lines(int): approximate number of lines to retain per job,
+           trimming the oldest. default unlimited.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for job_id, lines in logs.items():
+            key = self._key('log', job_id)
+            for l in lines:
+                #don't keep empty lines
+                if l and not l.isspace():
+                    pipe.xadd(key, {'line': l}, maxlen=max_lines,
+                              approximate=True)
+
+        if len(pipe):
+            pipe.execute()
+
+    @staticmethod
+    def _read_logentry(entry_id, fields, append_ts=True):
+        if not append_ts:
+            return fields['line']
+        ms = int(entry_id.split('-')[0])
+        ts = datetime.utcfromtimestamp(ms / 1000.0)
+        return '[%s] %s' % (ts.strftime('%a %b %d %H:%M:%S %Y'),
+                            fields['line'])
 
     @staticmethod
     def _read_jsonlog(jsonlog, append_ts=True):
@@ -195,105 +909,677 @@ class JobsDB(object):
             return msg
         return '[%s] %s' % (ts, msg)
 
-    @staticmethod
-    def _jsonlog(msg):
-        ts = datetime.utcnow().strftime('%a %b %d %H:%M:%S %Y')
-        return json.dumps((ts, msg))
+    #######
+    # Schedule Methods
+    #######
 
-    def _subscribe_to_log(self, job_id):
-        """ Subscribe this db object to a jobs log channel by ID """
-        key = self._key('log', job_id)
+    @timed(db_metric, db_metric_help)
+    def schedule_job(self, action_name, args=None, initiator=None,
+                     priority=None, run_at=None, cron=None):
+        """
+        Schedule a job to be created once at a given time, or repeatedly
+        on a cron schedule. Returns the id of the schedule
+        params:
+         - run_at(int): unix time at which to create the job
+         - cron(str): five field cron expression, in UTC
+        other params as for create_job
+        """
+        action = self.get_action(action_name)
+
+        if not action:
+            return (False, 'no such action')
+
+        if not self.check_permission(initiator, action):
+            log.debug('action denied: %s for user %s' % \
+                     (action_name, initiator))
+            return (False, 'Invalid user command')
+
+        if (run_at is None) == (cron is None):
+            return (False, 'exactly one of run_at or cron is required')
+
+        try:
+            if priority is not None:
+                priority = int(priority)
+            due = cron_next(cron, time()) if cron else int(run_at)
+        except ValueError as e:
+            return (False, str(e))
+
+        schedule = { 'id': str(uuid4().hex),
+                     'action': action_name,
+                     'args': args or '',
+                     'initiator': initiator or '',
+                     'priority': '' if priority is None else priority,
+                     'cron': cron or '' }
+
+        pipe = self.redis.pipeline()
+        self._add_schedule(pipe, schedule, due)
+        pipe.execute()
 
-        sub = self.redis.pubsub(ignore_subscribe_messages=True)
-        sub.subscribe(key)
-        self.subs[job_id] = sub
+        return (True, schedule['id'])
 
-        log.debug('Subscribed to log channel: %s' % key)
+    @timed(db_metric, db_metric_help)
+    def unschedule_job(self, schedule_id):
+        """ Remove a scheduled job by schedule ID """
+        pipe = self.redis.pipeline()
+        pipe.zrem(self._key('index', 'schedule'), schedule_id)
+        pipe.delete(self._key('schedule', schedule_id))
+        removed, _ = pipe.execute()
+        if not removed:
+            return (False, 'no such schedule')
+
+        return (True, '')
+
+    @timed(db_metric, db_metric_help)
+    def get_schedule(self, schedule_id):
+        """ Return a scheduled job by ID, with the time it is next due """
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hgetall(self._key('schedule', schedule_id))
+        pipe.zscore(self._key('index', 'schedule'), schedule_id)
+        schedule, due = pipe.execute()
+        if not schedule or due is None:
+            return None
+
+        schedule['next_run'] = int(due)
+        return schedule
+
+    @timed(db_metric, db_metric_help)
+    def get_schedules(self):
+        """ Return all scheduled jobs in the order they are due """
+        due = self.redis.zrange(self._key('index', 'schedule'), 0, -1,
+                                withscores=True)
+
+        pipe = self.redis.pipeline(transaction=False)
+        for schedule_id, _ in due:
+            pipe.hgetall(self._key('schedule', schedule_id))
+
+        schedules = []
+        for (_, score), schedule in zip(due, pipe.execute()):
+            if schedule:
+                schedule['next_run'] = int(score)
+                schedules.append(schedule)
+        return schedules
+
+    def next_schedule_time(self):
+        """ Return the unix time the next scheduled job is due, or None """
+        due = self.redis.zrange(self._key('index', 'schedule'), 0, 0,
+                                withscores=True)
+        return due[0][1] if due else None
+
+    def run_due_schedules(self, now=None):
+        """
+        Create the jobs of all schedules due by the given time, moving
+        recurring schedules to their next due time and removing others.
+        Each due time is claimed atomically, so a schedule fires once even
+        if several callers run it. Returns the ids of created jobs
+        """
+        now = now or time()
+        index = self._key('index', 'schedule')
+
+        job_ids = []
+        for schedule_id, due in self.redis.zrangebyscore(index, '-inf', now,
+                                                         withscores=True):
+            key = self._key('schedule', schedule_id)
+            schedule = self.redis.hgetall(key)
+
+            # a schedule missed while no scheduler ran fires once, and
+            # then resumes from the current time
+            next_due = ''
+            if schedule.get('cron'):
+                try:
+                    next_due = cron_next(schedule['cron'], max(now, due))
+                except ValueError as e:
+                    log.error('removing schedule %s: %s' % (schedule_id, e))
+
+            if not self._claim_schedule(keys=[ index, key ],
+                                        args=[ schedule_id, due, next_due ]):
+                continue
+            if not schedule:
+                continue
+
+            action = self.get_action(schedule['action'])
+            if not action:
+                log.warn('schedule %s: no such action %s' % \
+                         (schedule_id, schedule['action']))
+                continue
+
+            ok, result = self._create_jobs(action, [ schedule['args'] ],
+                                           schedule['initiator'] or None,
+                                           schedule['priority'] or None)
+            if not ok or not result[0]:
+                log.warn('schedule %s: job not created: %s' % \
+                         (schedule_id, result if not ok else 'queue full'))
+                continue
+            job_ids.append(result[0])
+
+        return job_ids
+
+    def acquire_scheduler(self, name, ttl):
+        """
+        Acquire or renew the scheduler lock, returning True if it is held
+        by the given name
+        params:
+         - name(str): unique name of the scheduler
+         - ttl(int): seconds the lock is held for unless renewed
+        """
+        return bool(self._acquire_lock(keys=[ self._key('queue',
+                                                        'scheduler_lock') ],
+                                       args=[ name, int(ttl * 1000) ]))
+
+    def wait_schedules(self, timeout):
+        """
+        Block until the schedule changes or the given number of seconds
+        passes, returning True if it changed
+        """
+        timeout = max(1, int(ceil(timeout)))
+        return bool(self.redis.blpop(self._key('queue', 'schedule_wake'),
+                                     timeout=timeout))
+
+    def _add_schedule(self, pipe, schedule, due):
+        key = self._key('schedule', schedule['id'])
+        pipe.delete(key)
+        pipe.hmset(key, schedule)
+        pipe.zadd(self._key('index', 'schedule'), {schedule['id']: due})
+
+        # wake the scheduler in case this is due before what it waits for
+        wake_key = self._key('queue', 'schedule_wake')
+        pipe.lpush(wake_key, 1)
+        pipe.ltrim(wake_key, 0, 0)
+
+    def _sync_action_schedules(self, actions):
+        """
+        Schedule jobs for actions configured with a cron schedule, removing
+        those of actions no longer scheduled
+        params:
+         - actions(dict): mapping of action name to action
+        """
+        index = self._key('index', 'schedule')
+        current = [ s for s in self.redis.zrange(index, 0, -1) \
+                    if s.startswith('action:') ]
+        crons = { a['name']: a['schedule'] for a in actions.values() \
+                  if a.get('schedule') }
+
+        pipe = self.redis.pipeline()
+        for schedule_id in current:
+            name = schedule_id[len('action:'):]
+            cron = self.redis.hget(self._key('schedule', schedule_id), 'cron')
+            if crons.get(name) == cron:
+                del crons[name]
+            else:
+                pipe.zrem(index, schedule_id)
+                pipe.delete(self._key('schedule', schedule_id))
+
+        for name, cron in crons.items():
+            try:
+                due = cron_next(cron, time())
+            except ValueError as e:
+                log.error('action %s: invalid schedule: %s' % (name, e))
+                continue
+            schedule = { 'id': 'action:' + name,
+                         'action': name,
+                         'args': '',
+                         'initiator': 'scheduler',
+                         'priority': '',
+                         'cron': cron }
+            self._add_schedule(pipe, schedule, due)
+
+        pipe.execute()
+
+    #######
+    # Config Methods
+    #######
+
+    @timed(db_metric, db_metric_help)
+    def load_config(self, version, actions, groups):
+        """
+        Replace the configured actions and groups in a single transaction,
+        changing only entries that differ. Returns False without changes
+        if this config version is already loaded.
+        params:
+         - version(str): Unique identifier of this config, e.g. a hash
+         - actions(list): list of action dicts
+         - groups(dict): mapping of group name to list of members
+        """
+        version_key = self._key('config', 'version')
+        action_index = self._key('index', 'actions')
+        group_index = self._key('index', 'groups')
+        user_index = self._key('index', 'users')
+
+        actions = { a['name']: { k:str(v) for k,v in a.items() } \
+                    for a in actions }
+
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(version_key, action_index, group_index,
+                               user_index)
+                    if pipe.get(version_key) == version:
+                        return False
+
+                    current_actions = {}
+                    for name in pipe.smembers(action_index):
+                        key = self._key('action', name)
+                        current_actions[name] = pipe.hgetall(key)
+                    current_groups = {}
+                    for name in pipe.smembers(group_index):
+                        key = self._key('group', name)
+                        if pipe.type(key) == 'set':
+                            current_groups[name] = pipe.smembers(key)
+                        else:
+                            # stored as a list by older versions; rewrite
+                            current_groups[name] = None
+                    current_users = pipe.smembers(user_index)
+
+                    pipe.multi()
+                    for name in set(current_actions) - set(actions):
+                        pipe.delete(self._key('action', name))
+                        pipe.srem(action_index, name)
+                        self._release_blocked(pipe, name)
+                    for name, action in actions.items():
+                        if current_actions.get(name) == action:
+                            continue
+                        # limits may have changed; claims check them again
+                        self._release_blocked(pipe, name)
+                        pipe.delete(self._key('action', name))
+                        pipe.hmset(self._key('action', name), action)
+                        pipe.sadd(action_index, name)
+
+                    for name in set(current_groups) - set(groups):
+                        pipe.delete(self._key('group', name))
+                        pipe.srem(group_index, name)
+                    for name, members in groups.items():
+                        members = set(members)
+                        if current_groups.get(name) == members:
+                            continue
+                        pipe.delete(self._key('group', name))
+                        if members:
+                            pipe.sadd(self._key('group', name), *members)
+                        pipe.sadd(group_index, name)
+
+                    # rebuild the index of actions each user may run
+                    for user in current_users:
+                        pipe.delete(self._user_actions_key(user))
+                    pipe.delete(user_index)
+                    user_actions = self._user_actions(actions, groups)
+                    for user, names in user_actions.items():
+                        pipe.sadd(self._user_actions_key(user), *names)
+                    if user_actions:
+                        pipe.sadd(user_index, *user_actions.keys())
+
+                    pipe.set(version_key, version)
+                    self._publish_config_change(pipe)
+                    pipe.execute()
+                    break
+                except redis.exceptions.WatchError:
+                    continue
+
+        self._sync_action_schedules(actions)
+        return True
+
+    def _release_blocked(self, pipe, action_name):
+        """
+        Return all jobs of an action held back at its concurrency limit
+        to the ready queue
+        """
+        dispatch = self._key('queue', 'dispatch')
+        blocked = self._key('index', 'blocked:' + action_name)
+        pipe.zunionstore(dispatch, [ dispatch, blocked ], aggregate='MIN')
+        pipe.delete(blocked)
+
+    @staticmethod
+    def _user_actions(actions, groups):
+        """
+        Return a mapping of user name to the set of actions restricted
+        to groups that user belongs to
+        """
+        user_actions = {}
+        for name, action in actions.items():
+            allowed = action['allow_groups'].split(',')
+            if 'all' in allowed:
+                continue
+            for group in allowed:
+                for user in groups.get(group) or []:
+                    user_actions.setdefault(user, set()).add(name)
+
+        return user_actions
 
     #######
     # Action Methods
     #######
 
+    @timed(db_metric, db_metric_help)
     def get_action(self, action_name):
         """
         Return a single action dict, given the action name
         """
-        return self.redis.hgetall(self._key('action', action_name))
+        return dict(self._config_cache()['actions'].get(action_name, {}))
 
+    @timed(db_metric, db_metric_help)
     def get_actions(self):
         """
         Return all configured actions
         """
-        return [self.redis.hgetall(k) for k in
-                self.redis.keys(pattern=self._key('action', '*'))]
-
-    def add_action(self, action):
-        self.redis.hmset(self._key('action', action['name']), action)
+        return [ dict(a) for a in self._config_cache()['actions'].values() ]
 
-    def purge_actions(self):
-        [self.redis.delete(k) for k in
-         self.redis.keys(pattern=self._key('action', '*'))]
+    @timed(db_metric, db_metric_help)
+    def get_user_actions(self, user):
+        """
+        Return all actions a given user is allowed to run
+        """
+        allowed = self.redis.smembers(self._user_actions_key(user or ''))
+        return [ dict(a) for a in self._config_cache()['actions'].values() \
+                 if a['name'] in allowed or \
+                    'all' in a['allow_groups'].split(',') ]
 
     #######
     # Usergroup Methods
     #######
 
-    def check_user(self, user, groups):
+    @timed(db_metric, db_metric_help)
+    def check_permission(self, user, action):
         """
-        Check a list of groups to see if a user is a member to any
+        Check whether a user is allowed to run an action
         params:
          - user(str): user name
-         - groups(list): list of group names
+         - action(dict): action dict as returned by get_action
         """
-        if 'all' in groups:
+        if 'all' in action['allow_groups'].split(','):
             return True
-        for group in groups:
-            log.debug('checking group %s' % (group))
-            if user in self.get_group(group):
-                return True
-        return False
+        if not user:
+            return False
+        return self.redis.sismember(self._user_actions_key(user),
+                                    action['name'])
 
+    @timed(db_metric, db_metric_help)
     def get_group(self, group_name):
         """
         Return a list of usernames belonging to a group
         """
-        return self.redis.lrange(self._key('group', group_name), 0, -1)
+        return sorted(self._config_cache()['groups'].get(group_name, []))
 
+    @timed(db_metric, db_metric_help)
     def get_groups(self):
         """
         Return all configured groups
         """
-        key = self._key('group', '*')
-        groups = [ g.split(':')[1] for g in self.redis.keys(pattern=key) ]
-        return { g:self.get_group(g) for g in groups }
+        groups = self._config_cache()['groups']
+        return { g:sorted(m) for g,m in groups.items() }
+
+    #######
+    # Config Cache Methods
+    #######
+
+    def _config_cache(self):
+        """
+        Return the local copy of all actions and groups, loading it from
+        redis if it has been cleared by a config change or the config
+        change counter differs from that of the copy
+        """
+        cache = self._cache
+        if cache is not None:
+            if cache['checked'] + config_check_interval > time():
+                return cache
+            if self.redis.get(self._key('config', 'serial')) == \
+               cache['serial']:
+                cache['checked'] = time()
+                return cache
+            log.debug('config change missed, clearing cache')
+            self._invalidate_config_cache()
 
-    def add_group(self, group_name, members):
-        key = self._key('group', group_name)
-        for m in members:
-            self.redis.lpush(key, m)
+        self._watch_config_changes()
+
+        gen = self._cache_gen
+        cache = self._load_config_cache()
+        with self._cache_lock:
+            # don't keep a copy loaded before a concurrent change
+            if gen == self._cache_gen:
+                self._cache = cache
+
+        return cache
+
+    def _load_config_cache(self):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(self._key('config', 'serial'))
+        pipe.smembers(self._key('index', 'actions'))
+        pipe.smembers(self._key('index', 'groups'))
+        serial, actions, groups = pipe.execute()
+
+        actions = list(actions)
+        groups = list(groups)
+        for name in actions:
+            pipe.hgetall(self._key('action', name))
+        for name in groups:
+            pipe.smembers(self._key('group', name))
+        results = pipe.execute()
+
+        return { 'serial': serial,
+                 'checked': time(),
+                 'actions': { n:a for n,a in \
+                              zip(actions, results[:len(actions)]) if a },
+                 'groups': dict(zip(groups, results[len(actions):])) }
+
+    def _invalidate_config_cache(self):
+        with self._cache_lock:
+            self._cache = None
+            self._cache_gen += 1
+
+    def _watch_config_changes(self):
+        """
+        Subscribe to config change notifications, clearing the local
+        cache whenever one is received
+        """
+        with self._cache_lock:
+            if self._config_sub:
+                return
+            sub = self.redis.pubsub(ignore_subscribe_messages=True)
+            sub.subscribe(self._key('config', 'changes'))
+            self._config_sub = sub
 
-    def purge_groups(self):
-        [ self.redis.delete(k) for k in \
-          self.redis.keys(pattern=self._key('group', '*')) ]
+        def listen():
+            while True:
+                try:
+                    for msg in self._config_sub.listen():
+                        log.debug('config changed, clearing cache')
+                        self._invalidate_config_cache()
+                except Exception as e:
+                    # changes may have been missed while disconnected
+                    log.warn('config change subscription error: %s' % e)
+                    self._invalidate_config_cache()
+                    sleep(1)
+
+        thread = Thread(target=listen)
+        thread.daemon = True
+        thread.start()
+
+    def _publish_config_change(self, pipe):
+        pipe.incr(self._key('config', 'serial'))
+        pipe.publish(self._key('config', 'changes'), '1')
 
     #######
     # Job Worker Methods 
     #######
 
-    def register_worker(self, name, hostname):
+    @timed(db_metric, db_metric_help)
+    def register_worker(self, name, hostname, slots=0, running=0, load=0.0):
+        """
+        Record a worker heartbeat along with its current capacity
+        params:
+         - slots(int): Maximum number of concurrent jobs
+         - running(int): Number of jobs currently running
+         - load(float): One minute load average of the worker host
+        """
         key = self._key('worker', name)
-        worker = {'name': name, 'host': hostname}
+        worker = { 'name': name,
+                   'host': hostname,
+                   'slots': slots,
+                   'running': running,
+                   'load': '%.2f' % load }
+        busy = float(running) / slots if slots else 1.0
 
-        self.redis.hmset(key, worker)
-        self.redis.expire(key, 15)
+        pipe = self.redis.pipeline()
+        pipe.hmset(key, worker)
+        pipe.expire(key, worker_ttl)
+        pipe.zadd(self._key('index', 'workers'), {name: time()})
+        pipe.zadd(self._key('index', 'worker_load'), {name: busy})
+        # workers whose processing lists are checked for orphaned jobs
+        pipe.sadd(self._key('index', 'processing'), name)
+        if self._registered.get(name) != worker:
+            pipe.incr(self._serial_key('workers'))
+        pipe.execute()
+        self._registered[name] = worker
 
+    @timed(db_metric, db_metric_help)
     def get_workers(self):
-        return [ self.redis.hgetall(k) for k in \
-                 self.redis.keys(pattern=self._key('worker', '*')) ]
+        names = self._live_workers()
+        return self._get_hashes([ self._key('worker', n) for n in names ])
+
+    @timed(db_metric, db_metric_help)
+    def has_workers(self):
+        return len(self._live_workers()) > 0
+
+    @timed(db_metric, db_metric_help)
+    def least_loaded_worker(self):
+        """
+        Return the name of the live worker with a free job slot and the
+        lowest share of its slots in use, or None if all are full
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zrangebyscore(self._key('index', 'workers'),
+                           time() - worker_ttl, '+inf')
+        pipe.zrangebyscore(self._key('index', 'worker_load'), '-inf', '(1')
+        live, candidates = pipe.execute()
+
+        live = set(live)
+        for name in candidates:
+            if name in live:
+                return name
+        return None
+
+    def _live_workers(self):
+        """
+        Return names of workers with a recent heartbeat, dropping
+        expired workers from the registry
+        """
+        key = self._key('index', 'workers')
+        cutoff = time() - worker_ttl
+
+        pipe = self.redis.pipeline()
+        pipe.zrangebyscore(key, '-inf', cutoff)
+        pipe.zremrangebyscore(key, '-inf', cutoff)
+        pipe.zrange(key, 0, -1)
+        expired, _, live = pipe.execute()
+
+        if expired:
+            pipe.zrem(self._key('index', 'worker_load'), *expired)
+            pipe.incr(self._serial_key('workers'))
+            pipe.execute()
+
+        return live
+
+    #######
+    # Change Counter Methods
+    #######
+
+    @timed(db_metric, db_metric_help)
+    def get_serial(self, collection):
+        """
+        Return a counter that changes whenever a collection is modified
+        params:
+         - collection(str): one of jobs, actions, groups or workers
+        """
+        if collection == 'workers':
+            # workers leave by expiring rather than by a write
+            self._live_workers()
+        return self.redis.get(self._serial_key(collection)) or '0'
+
+    #######
+    # Metrics Methods
+    #######
+
+    def push_metrics(self, process, snapshot, ttl=30):
+        """
+        Store a snapshot of a process's metrics for collection by the API
+        params:
+         - process(str): unique name of the reporting process
+         - snapshot(dict): metrics as returned by Metrics.snapshot
+         - ttl(int): seconds to keep the snapshot if not pushed again
+        """
+        pipe = self.redis.pipeline()
+        pipe.set(self._key('metrics', process), json.dumps(snapshot), ex=ttl)
+        pipe.zadd(self._key('index', 'metrics'), {process: time() + ttl})
+        pipe.execute()
+
+    def get_pushed_metrics(self):
+        """
+        Return a mapping of process name to its latest metrics snapshot,
+        dropping processes that have stopped reporting
+        """
+        key = self._key('index', 'metrics')
+
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(key, '-inf', time())
+        pipe.zrange(key, 0, -1)
+        _, processes = pipe.execute()
+
+        pipe = self.redis.pipeline(transaction=False)
+        for p in processes:
+            pipe.get(self._key('metrics', p))
+
+        return { p:json.loads(s) for p,s in \
+                 zip(processes, pipe.execute()) if s }
+
+    #######
+    # Bulk Read Methods
+    #######
+
+    def _get_hashes(self, keys):
+        """
+        Fetch multiple hashes in a single round trip, skipping
+        any keys that no longer exist
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for k in keys:
+            pipe.hgetall(k)
+
+        return [ h for h in pipe.execute() if h ]
 
     #######
     # Keyname Methods
     #######
 
+    @staticmethod
+    def _dispatch_score(job):
+        """
+        Return the ready queue score of a job; lower scores are claimed
+        first, so each level of priority counts as priority_aging seconds
+        of waiting
+        """
+        queued = float(job.get('queued') or job['created'])
+        return queued - int(job.get('priority') or 0) * priority_aging
+
+    @staticmethod
+    def _confirm_deadline(job):
+        """
+        Return the unix time by which a pending job must be confirmed
+        """
+        timeout = int(job.get('confirm_timeout') or confirm_timeout)
+        return int(job['created']) + timeout
+
     def _key(self, keytype, id):
         return self.prefix[keytype] + ':' + id
+
+    def _user_actions_key(self, user):
+        return self._key('index', 'user_actions:' + user)
+
+    def _action_key(self, action_name, status=None):
+        if status:
+            return self._key('index',
+                             'action_status:%s:%s' % (action_name, status))
+        return self._key('index', 'action:' + action_name)
+
+    def _serial_key(self, collection):
+        if collection in ('actions', 'groups'):
+            return self._key('config', 'serial')
+        return self._key('index', 'serial:' + collection)
+
+    def _status_key(self, status):
+        return self._key('index', 'status:' + status)
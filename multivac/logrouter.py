@@ -0,0 +1,176 @@
+import re
+import logging
+import redis.exceptions
+
+from time import sleep
+from queue import Queue
+from threading import Thread, Condition
+
+log = logging.getLogger('multivac')
+
+# queued in place of further entries for a reader that has fallen behind
+overflow = object()
+
+# largest value of either part of a stream entry id
+max_id_part = 2 ** 64 - 1
+
+
+def parse_entry_id(entry_id):
+    """
+    Return a stream entry id as a comparable (ms, seq) tuple, raising
+    ValueError if it is not a valid id
+    """
+    match = re.fullmatch(r'([0-9]+)(?:-([0-9]+))?', entry_id)
+    if not match:
+        raise ValueError('invalid stream id: %s' % entry_id)
+    parsed = (int(match.group(1)), int(match.group(2) or 0))
+    if max(parsed) > max_id_part:
+        raise ValueError('stream id out of range: %s' % entry_id)
+    return parsed
+
+
+class LogRouter(object):
+    """
+    Follows the log streams of any number of jobs with a single blocking
+    XREAD, routing new entries to a queue per reader. Readers added while
+    a read is in progress interrupt it by writing to a wakeup stream, and
+    readers that fall too far behind are dropped rather than buffered
+    without limit.
+    params:
+     - redis(StrictRedis): client to read log streams with
+     - wake_key(str): key of a stream used only by this router
+     - block(int): milliseconds to wait for new entries per read
+    """
+    def __init__(self, redis, wake_key, block=1000):
+        self.redis = redis
+        self.wake_key = wake_key
+        self.block = block
+
+        self._subs = {}  # dict of stream key:list of subscriptions
+        self._cond = Condition()
+
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def subscribe(self, key, after='0', limit=None):
+        """
+        Follow a log stream, returning a queue that receives an
+        (entry id, fields) tuple for each entry following the given id,
+        and None once the stream reaches EOF
+        params:
+         - limit(int): maximum entries buffered for this reader. once
+           reached the reader receives overflow and is unsubscribed
+        """
+        # reject invalid ids here rather than in the reader thread
+        parse_entry_id(after)
+
+        queue = Queue()
+        with self._cond:
+            self._subs.setdefault(key, []).append({ 'after': after,
+                                                    'limit': limit,
+                                                    'queue': queue })
+            self._cond.notify()
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.xadd(self.wake_key, {'wake': '1'}, maxlen=1)
+        pipe.expire(self.wake_key, 3600)
+        pipe.execute()
+
+        return queue
+
+    def unsubscribe(self, key, queue):
+        """ Stop following a log stream for the given queue """
+        with self._cond:
+            subs = [ s for s in self._subs.get(key, []) \
+                     if s['queue'] is not queue ]
+            if subs:
+                self._subs[key] = subs
+            else:
+                self._subs.pop(key, None)
+
+    def _run(self):
+        wake_after = '0'
+        while True:
+            with self._cond:
+                while not self._subs:
+                    self._cond.wait()
+
+                # read from the earliest position any reader needs
+                streams = { k: min((s['after'] for s in subs),
+                                   key=parse_entry_id) \
+                            for k,subs in self._subs.items() }
+            streams[self.wake_key] = wake_after
+
+            try:
+                resp = self.redis.xread(streams, count=1000, block=self.block)
+            except redis.exceptions.ResponseError as e:
+                # one unreadable stream fails the read of all of them
+                log.error('error reading job logs: %s' % e)
+                self._drop_unreadable(streams)
+                continue
+            except Exception as e:
+                log.error('error reading job logs: %s' % e)
+                sleep(1)
+                continue
+
+            for key, entries in resp or []:
+                if key == self.wake_key:
+                    wake_after = entries[-1][0]
+                else:
+                    self._route(key, entries, streams[key])
+
+    def _drop_unreadable(self, streams):
+        """
+        Read each stream alone, ending the readers that a read fails for
+        so that the rest can be served
+        """
+        for key, after in streams.items():
+            if key == self.wake_key:
+                continue
+            try:
+                self.redis.xread({ key: after }, count=1)
+            except redis.exceptions.ResponseError as e:
+                log.error('unable to read %s, ending its readers: %s' % \
+                          (key, e))
+                with self._cond:
+                    subs = self._subs.get(key, [])
+                    for sub in subs:
+                        if sub['after'] == after:
+                            sub['queue'].put(None)
+                    subs = [ s for s in subs if s['after'] != after ]
+                    if subs:
+                        self._subs[key] = subs
+                    else:
+                        self._subs.pop(key, None)
+
+    def _route(self, key, entries, start):
+        start = parse_entry_id(start)
+        with self._cond:
+            subs = self._subs.get(key, [])
+            for sub in subs:
+                after = parse_entry_id(sub['after'])
+                if after < start:
+                    # added during this read from an earlier entry; the
+                    # next read starts from it
+                    continue
+                for entry_id, fields in entries:
+                    if parse_entry_id(entry_id) <= after:
+                        continue
+                    if 'eof' in fields:
+                        sub['queue'].put(None)
+                        sub['done'] = True
+                        break
+                    if sub['limit'] and sub['queue'].qsize() >= sub['limit']:
+                        sub['queue'].put(overflow)
+                        sub['done'] = True
+                        break
+                    sub['queue'].put((entry_id, fields))
+                    sub['after'] = entry_id
+
+            # readers are done with a stream once it ends or they overflow
+            subs = [ s for s in subs if not s.get('done') ]
+            if subs:
+                self._subs[key] = subs
+            else:
+                self._subs.pop(key, None)
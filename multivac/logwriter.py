@@ -0,0 +1,88 @@
+import logging
+
+from time import time
+from threading import Thread, Condition, Lock
+
+log = logging.getLogger('multivac')
+
+
+class LogWriter(object):
+    """
+    Buffers job output lines and writes them to redis in batches. A job's
+    buffer is flushed once it holds flush_lines lines or its oldest line
+    has waited flush_ms milliseconds, whichever comes first.
+    params:
+     - db(JobsDB): database to write logs to
+     - flush_lines(int): maximum buffered lines per job
+     - flush_ms(int): maximum time a line is buffered before being written
+     - max_lines(int): number of lines to retain per job. default unlimited.
+    """
+    def __init__(self, db, flush_lines=100, flush_ms=100, max_lines=None):
+        self.db = db
+        self.max_lines = max_lines
+        self.flush_lines = flush_lines
+        self.flush_secs = flush_ms / 1000.0
+
+        self._buffers = {}  # dict of job_id:list of lines
+        self._since = {}  # dict of job_id:time of oldest buffered line
+        self._full = set()  # job ids with flush_lines lines buffered
+        self._cond = Condition()
+        self._flush_lock = Lock()
+
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, job_id, line):
+        """
+        Buffer a single line of output for a job. Never blocks on redis,
+        so it is safe to call from an event loop
+        """
+        with self._cond:
+            if job_id not in self._buffers:
+                self._buffers[job_id] = []
+                self._since[job_id] = time()
+                self._cond.notify()
+            self._buffers[job_id].append(line)
+
+            if len(self._buffers[job_id]) == self.flush_lines:
+                self._full.add(job_id)
+                self._cond.notify()
+
+    def flush(self, *job_ids):
+        """
+        Write buffered lines for the given jobs, or all jobs if none given
+        """
+        # serialize flushes so lines for a job are written in order
+        with self._flush_lock:
+            with self._cond:
+                if not job_ids:
+                    job_ids = list(self._buffers.keys())
+                logs = {}
+                for job_id in job_ids:
+                    if job_id in self._buffers:
+                        logs[job_id] = self._buffers.pop(job_id)
+                        del self._since[job_id]
+                        self._full.discard(job_id)
+
+            if logs:
+                self.db.append_job_logs(logs, max_lines=self.max_lines)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._since:
+                    self._cond.wait()
+
+                cutoff = time() - self.flush_secs
+                due = [ j for j,t in self._since.items() if t <= cutoff ]
+                due += [ j for j in self._full if j not in due ]
+
+                if not due:
+                    self._cond.wait(min(self._since.values()) - cutoff)
+                    continue
+
+            try:
+                self.flush(*due)
+            except Exception as e:
+                log.error('error flushing job logs: %s' % e)
@@ -0,0 +1,147 @@
+import logging
+
+from time import sleep, perf_counter
+from functools import wraps
+from threading import Thread, Lock
+
+log = logging.getLogger('multivac')
+
+
+class Metrics(object):
+    """
+    Process-local registry of counters, gauges and summaries. Summaries
+    keep a count and sum of observed values, as in Prometheus.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics = {}  # dict of name:{type, help, values}
+
+    def inc(self, name, value=1, help='', **labels):
+        """ Increment a counter """
+        with self._lock:
+            values = self._values(name, 'counter', help)
+            key = self._labels(labels)
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, help='', **labels):
+        """ Set the current value of a gauge """
+        with self._lock:
+            self._values(name, 'gauge', help)[self._labels(labels)] = value
+
+    def observe(self, name, value, help='', **labels):
+        """ Record an observed value, e.g. a duration, in a summary """
+        with self._lock:
+            values = self._values(name, 'summary', help)
+            key = self._labels(labels)
+            count, total = values.get(key, (0, 0.0))
+            values[key] = (count + 1, total + value)
+
+    def snapshot(self):
+        """
+        Return a JSON serializable copy of all metrics
+        """
+        with self._lock:
+            return { name: { 'type': m['type'],
+                             'help': m['help'],
+                             'samples': [ [dict(l), v] for l,v in \
+                                          m['values'].items() ] } \
+                     for name, m in self._metrics.items() }
+
+    def _values(self, name, mtype, help):
+        if name not in self._metrics:
+            self._metrics[name] = { 'type': mtype,
+                                    'help': help,
+                                    'values': {} }
+        return self._metrics[name]['values']
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items()))
+
+
+registry = Metrics()
+
+
+def timed(name, help=''):
+    """
+    Decorator recording the call count and duration of a method in a
+    summary labeled with the method name
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                registry.observe(name, perf_counter() - start, help=help,
+                                 method=func.__name__)
+        return wrapper
+    return decorator
+
+
+def render(snapshots):
+    """
+    Render metric snapshots from any number of processes in the
+    Prometheus text format, labeling each sample with its process
+    params:
+     - snapshots(dict): mapping of process name to snapshot
+    """
+    merged = {}
+    for process, snapshot in sorted(snapshots.items()):
+        for name, m in snapshot.items():
+            if name not in merged:
+                merged[name] = { 'type': m['type'],
+                                 'help': m['help'],
+                                 'samples': [] }
+            for labels, value in m['samples']:
+                labels = dict(labels, process=process)
+                merged[name]['samples'].append((labels, value))
+
+    lines = []
+    for name, m in sorted(merged.items()):
+        if m['help']:
+            lines.append('# HELP %s %s' % (name, m['help']))
+        lines.append('# TYPE %s %s' % (name, m['type']))
+        for labels, value in m['samples']:
+            if m['type'] == 'summary':
+                count, total = value
+                lines.append(_sample(name + '_count', labels, count))
+                lines.append(_sample(name + '_sum', labels, total))
+            else:
+                lines.append(_sample(name, labels, value))
+
+    return '\n'.join(lines) + '\n'
+
+
+def _sample(name, labels, value):
+    pairs = [ '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+              for k,v in sorted(labels.items()) ]
+    return '%s{%s} %s' % (name, ','.join(pairs), value)
+
+
+def start_pusher(db, process, interval=10, collect=None):
+    """
+    Periodically push this process's metrics into redis, where the API
+    collects them for processes without an HTTP server of their own
+    params:
+     - db(JobsDB): database to push metrics to
+     - process(str): unique name of this process
+     - interval(int): seconds between pushes
+     - collect(func): optional function called before each push to
+       update gauges
+    """
+    def push():
+        while True:
+            try:
+                if collect:
+                    collect()
+                db.push_metrics(process, registry.snapshot(),
+                                ttl=interval * 3)
+            except Exception as e:
+                log.error('error pushing metrics: %s' % e)
+            sleep(interval)
+
+    thread = Thread(target=push)
+    thread.daemon = True
+    thread.start()
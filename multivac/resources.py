@@ -1,12 +1,37 @@
 import json
-import operator
+from time import time
+from functools import wraps
+from collections import OrderedDict
 from flask import Response, current_app, stream_with_context
 from flask_restful import Resource, Api, reqparse, request, abort
 
 from multivac.version import version
+from multivac.logrouter import parse_entry_id
 
 app = current_app
 
+# seconds to reuse change counters read from redis before checking again
+serial_ttl = 1
+
+# seconds to keep cached responses that are no longer requested, and the
+# most responses kept, least recently used first to go
+response_ttl = 60
+max_cached_responses = 100
+
+# number of jobs returned per page unless a limit is given, and the
+# largest limit allowed
+default_page_size = 100
+max_page_size = 1000
+
+# maximum number of jobs created by one batch request
+max_batch_jobs = 1000
+
+# seconds between keepalive comments on an idle event stream
+event_keepalive = 15
+
+_serials = {}  # dict of collection:(counter, expiry)
+_responses = OrderedDict()  # request path:(etag, expiry, response data)
+
 def make_response(msg=None):
     response_msg = {'ok': True}
     if msg:
@@ -27,6 +52,57 @@ def make_error(status_code, msg):
 def invalid_resource():
     return make_error(410, 'a resource with that id does not exist')
 
+def conditional(collection):
+    """
+    Decorator for GET methods of collection resources. Responses carry an
+    ETag derived from the collection's change counter in redis; requests
+    with a matching If-None-Match get a 304, and responses are cached by
+    this process until the collection changes
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            now = time()
+            serial, expiry = _serials.get(collection, (None, 0))
+            if expiry < now:
+                serial = app.config['db'].get_serial(collection)
+                _serials[collection] = (serial, now + serial_ttl)
+
+            etag = '%s-%s' % (collection, serial)
+            headers = { 'ETag': '"%s"' % etag }
+            if request.if_none_match.contains_weak(etag):
+                return Response(status=304, headers=headers)
+
+            cached = _responses.get(request.full_path)
+            if cached and cached[0] == etag:
+                data = cached[2]
+            else:
+                result = func(*args, **kwargs)
+                if isinstance(result, Response):
+                    return result
+                data, status = result
+                if status != 200:
+                    return data, status
+            _responses[request.full_path] = (etag, now + response_ttl, data)
+            _responses.move_to_end(request.full_path)
+
+            for path, (_, expiry, _) in list(_responses.items()):
+                if expiry < now:
+                    del _responses[path]
+            while len(_responses) > max_cached_responses:
+                _responses.popitem(last=False)
+
+            return data, 200, headers
+        return wrapper
+    return decorator
+
+def valid_entry_id(entry_id):
+    try:
+        parse_entry_id(entry_id)
+    except ValueError:
+        return False
+    return True
+
 class Version(Resource):
     def get(self):
         return {'version': 'v%s' % version}, 200
@@ -38,10 +114,10 @@ class Confirm(Resource):
         job = db.get_job(job_id)
         if not job:
             return invalid_resource()
-        if job['status'] != 'pending':
-            return make_error(400, 'job not awaiting confirm')
 
-        db.update_job(job_id, 'status', 'ready')
+        ok,result = db.confirm_job(job_id)
+        if not ok:
+            return make_error(400, result)
 
         return {'ok': True}
 
@@ -68,23 +144,72 @@ class Job(Resource):
         return job, 200
 
 class Jobs(Resource):
+    @conditional('jobs')
     def get(self):
-        db = app.config['db']
-        jobs = db.get_jobs()
-        jobs.sort(key=operator.itemgetter('created'), reverse=True)
-
-        return jobs, 200
+        args = self._parse_filters()
+        limit = args['limit'] or default_page_size
+        if not 0 < limit <= max_page_size:
+            return make_error(400, 'limit must be between 1 and %s' % \
+                                   max_page_size)
+        if args['before'] and args['after']:
+            return make_error(400, 'only one of before or after is allowed')
+
+        return app.config['db'].get_jobs(status=args['status'] or 'all',
+                                         action=args['action'],
+                                         limit=limit,
+                                         before=args['before'],
+                                         after=args['after']), 200
+
+    def _parse_filters(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument('status', type=str)
+        parser.add_argument('action', type=str)
+        parser.add_argument('limit', type=int)
+        parser.add_argument('before', type=str)
+        parser.add_argument('after', type=str)
+        return parser.parse_args()
 
     def post(self):
         args = self._parse()
         db = app.config['db']
 
         if not args['action']:
-            return make_error('missing required parameter "action"', 400)
+            return make_error(400, 'missing required parameter "action"')
+
+        if args['run_at'] is not None or args['cron']:
+            if args['batch_args']:
+                return make_error(400, 'batch_args cannot be combined ' \
+                                       'with run_at or cron')
+
+            ok,result = db.schedule_job(args['action'],
+                                        args=args['action_args'],
+                                        initiator='api_user',
+                                        priority=args['priority'],
+                                        run_at=args['run_at'],
+                                        cron=args['cron'])
+            if not ok:
+                return make_error(400, result)
+
+            return {'schedule_id': result}, 200
+
+        if args['batch_args']:
+            if len(args['batch_args']) > max_batch_jobs:
+                return make_error(400, 'at most %s jobs may be created ' \
+                                       'per request' % max_batch_jobs)
+
+            ok,result = db.create_jobs(args['action'],
+                                       args['batch_args'],
+                                       initiator='api_user',
+                                       priority=args['priority'])
+            if not ok:
+                return make_error(400, result)
+
+            return {'ids': result}, 200
 
         ok,result = db.create_job(args['action'],
                                   args=args['action_args'],
-                                  initiator='api_user')
+                                  initiator='api_user',
+                                  priority=args['priority'])
         if not ok:
             return make_error(400, result)
 
@@ -94,8 +219,31 @@ class Jobs(Resource):
         parser = reqparse.RequestParser()
         parser.add_argument('action', type=str)
         parser.add_argument('action_args', type=str)
+        parser.add_argument('batch_args', type=str, action='append')
+        parser.add_argument('priority', type=int)
+        parser.add_argument('run_at', type=int)
+        parser.add_argument('cron', type=str)
         return parser.parse_args()
 
+class Schedule(Resource):
+    def get(self, schedule_id):
+        schedule = app.config['db'].get_schedule(schedule_id)
+        if not schedule:
+            return invalid_resource()
+
+        return schedule, 200
+
+    def delete(self, schedule_id):
+        ok,result = app.config['db'].unschedule_job(schedule_id)
+        if not ok:
+            return invalid_resource()
+
+        return { 'ok': True }
+
+class Schedules(Resource):
+    def get(self):
+        return app.config['db'].get_schedules(), 200
+
 class Logs(Resource):
     def get(self, job_id):
         args = self._parse()
@@ -106,16 +254,86 @@ class Logs(Resource):
                 yield l + '\n'
 
         if args['json']:
-            return [l for l in db.get_stored_log(job_id)], 200
-
-        logstream = db.get_log(job_id)
+            return db.get_stored_log(job_id,
+                                     offset=args['offset'] or 0,
+                                     limit=args['limit'],
+                                     tail=args['tail']), 200
+
+        if args['after']:
+            if not valid_entry_id(args['after']):
+                return make_error(400, 'invalid log entry id')
+            logstream = db.get_logstream(job_id, after=args['after'])
+        else:
+            logstream = db.get_log(job_id)
         return Response(stream_with_context(stream(logstream)))
 
     def _parse(self):
         parser = reqparse.RequestParser()
         parser.add_argument('json', type=bool)
+        parser.add_argument('after', type=str)
+        parser.add_argument('offset', type=int)
+        parser.add_argument('limit', type=int)
+        parser.add_argument('tail', type=int)
         return parser.parse_args()
 
+class LogEvents(Resource):
+    """
+    Stream job output as server-sent events, using log entry ids as event
+    ids so that reconnecting clients resume from Last-Event-ID. Sends an
+    'eof' event once the job has completed.
+    """
+    def get(self, job_id):
+        db = app.config['db']
+
+        if not db.get_job(job_id):
+            return invalid_resource()
+
+        after = request.headers.get('Last-Event-ID') or \
+                request.args.get('after') or '0'
+        if not valid_entry_id(after):
+            return make_error(400, 'invalid log entry id')
+
+        def stream():
+            for entry_id, line in db.get_logstream(job_id, after=after,
+                                                   entry_ids=True):
+                data = ''.join('data: %s\n' % l for l in line.splitlines())
+                yield 'id: %s\n%s\n' % (entry_id, data)
+            yield 'event: eof\ndata: \n\n'
+
+        return Response(stream_with_context(stream()),
+                        mimetype='text/event-stream',
+                        headers={ 'Cache-Control': 'no-cache',
+                                  'X-Accel-Buffering': 'no' })
+
+class JobEvents(Resource):
+    """
+    Stream job status changes as server-sent events, optionally for a
+    single job given by ?job_id. Reconnecting clients resume from
+    Last-Event-ID.
+    """
+    def get(self):
+        db = app.config['db']
+
+        job_id = request.args.get('job_id')
+        after = request.headers.get('Last-Event-ID') or \
+                request.args.get('after')
+        if after and not valid_entry_id(after):
+            return make_error(400, 'invalid event id')
+
+        def stream():
+            for entry in db.job_events(after=after, job_id=job_id,
+                                       idle=event_keepalive):
+                if entry is None:
+                    yield ':\n\n'
+                    continue
+                entry_id, event = entry
+                yield 'id: %s\ndata: %s\n\n' % (entry_id, json.dumps(event))
+
+        return Response(stream_with_context(stream()),
+                        mimetype='text/event-stream',
+                        headers={ 'Cache-Control': 'no-cache',
+                                  'X-Accel-Buffering': 'no' })
+
 class Action(Resource):
     def get(self, action_name):
         action = app.config['db'].get_action(action_name)
@@ -125,6 +343,7 @@ class Action(Resource):
         return action, 200
 
 class Actions(Resource):
+    @conditional('actions')
     def get(self):
         return app.config['db'].get_actions(), 200
 
@@ -137,9 +356,11 @@ class Group(Resource):
         return group, 200
 
 class Groups(Resource):
+    @conditional('groups')
     def get(self):
         return app.config['db'].get_groups(), 200
 
 class Workers(Resource):
+    @conditional('workers')
     def get(self):
         return app.config['db'].get_workers(), 200
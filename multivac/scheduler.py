@@ -0,0 +1,49 @@
+import logging
+
+from time import time, sleep
+from threading import Thread
+
+log = logging.getLogger('multivac')
+
+
+class Scheduler(object):
+    """
+    Creates scheduled jobs as they fall due. Any number of schedulers may
+    run, but only the one holding the scheduler lock reads the schedule;
+    it sleeps until the next entry is due or the schedule changes, while
+    the others wait to take over should it go away.
+    params:
+     - db(JobsDB): database to read schedules from
+     - name(str): unique name of this scheduler, e.g. the worker name
+     - lock_ttl(int): seconds the lock is held for if not renewed
+    """
+    def __init__(self, db, name, lock_ttl=30):
+        self.db = db
+        self.name = name
+        self.lock_ttl = lock_ttl
+
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        # renew the lock well before it expires
+        interval = self.lock_ttl / 3.0
+        while True:
+            try:
+                if not self.db.acquire_scheduler(self.name, self.lock_ttl):
+                    sleep(interval)
+                    continue
+
+                for job_id in self.db.run_due_schedules():
+                    log.info('created scheduled job %s' % job_id)
+
+                timeout = interval
+                next_due = self.db.next_schedule_time()
+                if next_due is not None:
+                    timeout = min(timeout, next_due - time())
+                if timeout > 0:
+                    self.db.wait_schedules(timeout)
+            except Exception as e:
+                log.error('error running scheduled jobs: %s' % e)
+                sleep(1)
@@ -0,0 +1,260 @@
+"""
+Lua scripts run server side by JobsDB for updates that must be atomic.
+Keys built inside a script are derived from prefixes passed in ARGV.
+"""
+
+# Write a new job hash and its index entries, queueing it if ready or
+# recording its confirmation deadline if pending, and add a status event.
+# Rejects the job if its action already has max queued jobs waiting.
+# KEYS: job hash, created index, status index, ready queue,
+#       action queued set, signal list, jobs change counter,
+#       action created index, action status index, confirm deadline index,
+#       job events stream
+# ARGV: job id, created time, status, max queued or '', max signals,
+#       dispatch score, confirm deadline, max events, job hash field/value
+#       pairs
+# Returns 1 if created, 0 if rejected
+create_job = """
+local max = tonumber(ARGV[4])
+if max and redis.call('SCARD', KEYS[5]) >= max then
+    return 0
+end
+redis.call('HMSET', KEYS[1], unpack(ARGV, 9))
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+redis.call('ZADD', KEYS[3], ARGV[2], ARGV[1])
+redis.call('ZADD', KEYS[8], ARGV[2], ARGV[1])
+redis.call('ZADD', KEYS[9], ARGV[2], ARGV[1])
+redis.call('SADD', KEYS[5], ARGV[1])
+redis.call('INCR', KEYS[7])
+local name = redis.call('HGET', KEYS[1], 'name') or ''
+redis.call('XADD', KEYS[11], 'MAXLEN', '~', ARGV[8], '*', 'job', ARGV[1],
+           'action', name, 'status', ARGV[3])
+if ARGV[3] == 'ready' then
+    redis.call('ZADD', KEYS[4], ARGV[6], ARGV[1])
+    redis.call('LPUSH', KEYS[6], '1')
+    redis.call('LTRIM', KEYS[6], 0, ARGV[5] - 1)
+elseif ARGV[3] == 'pending' then
+    redis.call('ZADD', KEYS[10], ARGV[7], ARGV[1])
+end
+return 1
+"""
+
+# Function used by scripts that free a slot of an action: moves the lowest
+# scored of the action's jobs held back at its max_concurrent limit to the
+# ready queue, one per free slot, or all of them if it has no limit.
+# params: action name, ready queue, index key prefix, action key prefix
+release_blocked = """
+local function release_blocked(name, ready, index_prefix, action_prefix)
+    local blocked = index_prefix .. 'blocked:' .. name
+    local stop = -1
+    local limit = redis.call('HGET', action_prefix .. name, 'max_concurrent')
+    if tonumber(limit or '') then
+        local active = redis.call('SCARD', index_prefix .. 'active:' .. name)
+        stop = tonumber(limit) - active - 1
+        if stop < 0 then
+            return
+        end
+    end
+    local jobs = redis.call('ZRANGE', blocked, 0, stop, 'WITHSCORES')
+    for i = 1, #jobs, 2 do
+        redis.call('ZADD', ready, jobs[i + 1], jobs[i])
+        redis.call('ZREM', blocked, jobs[i])
+    end
+end
+"""
+
+# Move a job between status indexes, including those of its action, and
+# update its hash in one step, optionally requiring a current status and
+# adding it to the ready queue, in which case the time it was queued is
+# recorded in the job hash and it is scored by that time less its priority
+# times the aging interval.
+# Finished jobs are recorded in the finished index by finish time. Keeps
+# the per-action sets of queued (pending or ready) and active (claimed or
+# running) jobs up to date, and wakes idle workers when a job is queued
+# or frees a slot. Jobs leave the confirm deadline index on any change,
+# as only pending jobs have a deadline. A status event is added if the
+# status changed.
+# KEYS: job hash, new status index, ready queue, finished index,
+#       signal list, jobs change counter, job events stream,
+#       confirm deadline index, all status indexes
+# ARGV: job id, new status, required current status or '', '1' to enqueue,
+#       finish time or '', index key prefix, max signals, current time,
+#       seconds of aging per priority level, max events, action key prefix
+# Returns 1 on success, 0 if no such job, -1 if in the wrong status
+set_status = release_blocked + """
+local job = redis.call('HMGET', KEYS[1], 'created', 'status', 'name',
+                       'priority')
+if not job[1] then
+    return 0
+end
+if ARGV[3] ~= '' and job[2] ~= ARGV[3] then
+    return -1
+end
+redis.call('HSET', KEYS[1], 'status', ARGV[2])
+redis.call('INCR', KEYS[6])
+if job[2] ~= ARGV[2] then
+    redis.call('XADD', KEYS[7], 'MAXLEN', '~', ARGV[10], '*', 'job', ARGV[1],
+               'action', job[3] or '', 'status', ARGV[2])
+end
+for i = 8, #KEYS do
+    redis.call('ZREM', KEYS[i], ARGV[1])
+end
+redis.call('ZADD', KEYS[2], job[1], ARGV[1])
+
+local by_action = ARGV[6] .. 'action_status:' .. (job[3] or '') .. ':'
+redis.call('ZREM', by_action .. job[2], ARGV[1])
+redis.call('ZADD', by_action .. ARGV[2], job[1], ARGV[1])
+
+local queued = ARGV[6] .. 'queued:' .. (job[3] or '')
+local active = ARGV[6] .. 'active:' .. (job[3] or '')
+if ARGV[2] == 'pending' or ARGV[2] == 'ready' then
+    redis.call('SADD', queued, ARGV[1])
+elseif ARGV[2] == 'running' then
+    redis.call('SREM', queued, ARGV[1])
+    redis.call('SADD', active, ARGV[1])
+else
+    redis.call('SREM', queued, ARGV[1])
+    if redis.call('SREM', active, ARGV[1]) == 1 and job[3] then
+        release_blocked(job[3], KEYS[3], ARGV[6], ARGV[11])
+    end
+end
+
+local signal = false
+if ARGV[4] == '1' then
+    local score = ARGV[8] - (tonumber(job[4] or '') or 0) * ARGV[9]
+    redis.call('HSET', KEYS[1], 'queued', ARGV[8])
+    redis.call('ZADD', KEYS[3], score, ARGV[1])
+    signal = true
+end
+if ARGV[5] ~= '' then
+    redis.call('ZADD', KEYS[4], ARGV[5], ARGV[1])
+    signal = true
+end
+if signal then
+    redis.call('LPUSH', KEYS[5], '1')
+    redis.call('LTRIM', KEYS[5], 0, ARGV[7] - 1)
+end
+return 1
+"""
+
+# Claim the lowest scored ready job whose action is below its
+# max_concurrent limit, reading ARGV[1] jobs at a time. Jobs of actions at
+# their limit are moved aside to the action's blocked queue until a slot
+# frees, so they never hold back jobs of other actions. The claimed job is
+# moved to the processing list and counted as active instead of queued
+# for its action.
+# KEYS: ready queue, processing list
+# ARGV: claim batch size, job key prefix, action key prefix,
+#       index key prefix
+# Returns the claimed job id or nil
+claim_job = """
+local limits = {}
+while true do
+    local ids = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1,
+                           'WITHSCORES')
+    if #ids == 0 then
+        return false
+    end
+    for i = 1, #ids, 2 do
+        local id = ids[i]
+        local name = redis.call('HGET', ARGV[2] .. id, 'name')
+        local ok = true
+        if name then
+            local active = ARGV[4] .. 'active:' .. name
+            if limits[name] == nil then
+                local limit = redis.call('HGET', ARGV[3] .. name,
+                                         'max_concurrent')
+                limits[name] = tonumber(limit or '') or false
+            end
+            if limits[name] and
+               redis.call('SCARD', active) >= limits[name] then
+                ok = false
+            else
+                redis.call('SREM', ARGV[4] .. 'queued:' .. name, id)
+                redis.call('SADD', active, id)
+            end
+        end
+        redis.call('ZREM', KEYS[1], id)
+        if ok then
+            redis.call('LPUSH', KEYS[2], id)
+            return id
+        end
+        redis.call('ZADD', ARGV[4] .. 'blocked:' .. name, ids[i + 1], id)
+    end
+end
+"""
+
+# Move one job from a processing list back to the front of the ready
+# queue, so recovered jobs are claimed next, and count it as queued
+# instead of active for its action. Jobs no longer ready or running, or
+# whose hash is gone, are only removed from the processing list.
+# KEYS: processing list, ready queue
+# ARGV: job key prefix, index key prefix, action key prefix
+# Returns the job id and 1 if requeued or 0 if dropped, or nil if empty
+requeue_job = release_blocked + """
+local job_id = redis.call('RPOP', KEYS[1])
+if not job_id then
+    return false
+end
+local job = redis.call('HMGET', ARGV[1] .. job_id, 'name', 'status')
+if job[2] ~= 'ready' and job[2] ~= 'running' then
+    return {job_id, 0}
+end
+redis.call('ZADD', KEYS[2], '-inf', job_id)
+if job[1] then
+    redis.call('SREM', ARGV[2] .. 'active:' .. job[1], job_id)
+    redis.call('SADD', ARGV[2] .. 'queued:' .. job[1], job_id)
+    release_blocked(job[1], KEYS[2], ARGV[2], ARGV[3])
+end
+return {job_id, 1}
+"""
+
+# Stop counting a job as active for its action, moving blocked jobs of the
+# action back to the ready queue and waking idle workers if a slot frees.
+# KEYS: ready queue, signal list
+# ARGV: job id, action name, index key prefix, action key prefix,
+#       max signals
+release_slot = release_blocked + """
+if redis.call('SREM', ARGV[3] .. 'active:' .. ARGV[2], ARGV[1]) == 1 then
+    release_blocked(ARGV[2], KEYS[1], ARGV[3], ARGV[4])
+    redis.call('LPUSH', KEYS[2], '1')
+    redis.call('LTRIM', KEYS[2], 0, ARGV[5] - 1)
+end
+"""
+
+# Take a due schedule entry if it is still due at the expected time, either
+# moving it to its next due time or removing it if it does not recur.
+# Only one caller can take each due time, so schedules never fire twice.
+# KEYS: schedule index, schedule hash
+# ARGV: schedule id, expected due time, next due time or ''
+# Returns 1 if taken, 0 if already taken or removed
+claim_schedule = """
+local due = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not due or tonumber(due) ~= tonumber(ARGV[2]) then
+    return 0
+end
+if ARGV[3] == '' then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('DEL', KEYS[2])
+else
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+end
+return 1
+"""
+
+# Acquire or renew a lock held by a single owner until it expires.
+# KEYS: lock
+# ARGV: owner name, lock ttl in milliseconds
+# Returns 1 if held by the owner, 0 if held by another
+acquire_lock = """
+local owner = redis.call('GET', KEYS[1])
+if owner == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+if not owner then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+return 0
+"""
@@ -1,4 +1,6 @@
-from datetime import datetime
+import calendar
+
+from datetime import datetime, timedelta
 
 def unix_time(dt):
     epoch = datetime.utcfromtimestamp(0)
@@ -9,3 +11,78 @@ def format_time(unix_time):
     if isinstance(unix_time, str):
         unix_time = int(unix_time)
     return datetime.fromtimestamp(unix_time).strftime('%Y-%m-%d %H:%M:%S')
+
+# ranges of the minute, hour, day of month, month and day of week fields
+cron_ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+def parse_cron(expr):
+    """
+    Parse a five field cron expression into sets of allowed minutes, hours,
+    days of month, months and days of week (0 is Sunday). Supports *, lists,
+    ranges and steps. Raises ValueError if the expression is invalid
+    """
+    fields = expr.split()
+    if len(fields) != 5:
+        raise ValueError('cron expression must have 5 fields: %s' % expr)
+
+    parsed = []
+    for field, (low, high) in zip(fields, cron_ranges):
+        values = set()
+        for part in field.split(','):
+            span, _, step = part.partition('/')
+            step = int(step) if step else 1
+            if span == '*':
+                start, end = low, high
+            elif '-' in span:
+                start, end = [ int(v) for v in span.split('-', 1) ]
+            else:
+                start = int(span)
+                end = high if step > 1 else start
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError('invalid cron field: %s' % field)
+            values.update(range(start, end + 1, step))
+        parsed.append(values)
+
+    # both 0 and 7 mean Sunday
+    if 7 in parsed[4]:
+        parsed[4] = (parsed[4] - {7}) | {0}
+
+    return parsed
+
+def cron_next(expr, after):
+    """
+    Return the unix time of the first minute matching a cron expression
+    after a given unix time, in UTC so that every process agrees. As in
+    cron, a day matches if either the day of month or day of week matches
+    when both are restricted, i.e. neither starts with *
+    """
+    minutes, hours, days, months, weekdays = parse_cron(expr)
+    fields = expr.split()
+    any_day = fields[2].startswith('*') or fields[4].startswith('*')
+
+    t = datetime.utcfromtimestamp(after).replace(second=0, microsecond=0)
+    t += timedelta(minutes=1)
+    end = t + timedelta(days=366 * 5)
+    while t < end:
+        if t.month not in months:
+            t = (t.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0,
+                                                                minute=0)
+            continue
+
+        day = t.day in days
+        weekday = t.isoweekday() % 7 in weekdays
+        if not ((day and weekday) if any_day else (day or weekday)):
+            t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            continue
+
+        if t.hour not in hours:
+            t = t.replace(minute=0) + timedelta(hours=1)
+            continue
+
+        if t.minute not in minutes:
+            t += timedelta(minutes=1)
+            continue
+
+        return calendar.timegm(t.timetuple())
+
+    raise ValueError('cron expression never matches: %s' % expr)
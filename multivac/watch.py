@@ -0,0 +1,73 @@
+import os
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+log = logging.getLogger('multivac')
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+event_header = struct.Struct('iIII')
+
+
+class FileWatcher(object):
+    """
+    Watch a file for changes using Linux inotify. The containing directory
+    is watched so that files replaced by a rename, as done by most editors
+    and by Kubernetes configmap updates, are seen as well.
+    Raises OSError where inotify is not available.
+    params:
+     - path(str): path of the file to watch
+    """
+    def __init__(self, path):
+        path = os.path.abspath(path)
+        self.name = os.path.basename(path)
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify not available')
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        wd = libc.inotify_add_watch(self.fd,
+                                    os.path.dirname(path).encode(),
+                                    mask)
+        if wd < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """
+        Consume pending events, returning True if any concern the file
+        """
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return False
+
+        changed = False
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = event_header.unpack_from(data, offset)
+            offset += event_header.size
+            name = data[offset:offset + length].rstrip(b'\0').decode()
+            offset += length
+
+            # configmap volumes swap a '..data' symlink on update
+            if name in (self.name, '..data'):
+                changed = True
+
+        return changed
+
+    def close(self):
+        os.close(self.fd)
@@ -1,27 +1,53 @@
 import os
 import socket
 import logging
+import asyncio
 import yaml
-import subprocess
-import fcntl
 import shlex
+import hashlib
+import json
 import names
 
-from time import time, sleep
-from redis import StrictRedis
+from time import time
 from copy import deepcopy
+from functools import partial
 from concurrent.futures import ThreadPoolExecutor
 
-from multivac.util import unix_time
+from multivac import metrics
+from multivac.util import parse_cron
 from multivac.db import JobsDB
+from multivac.logwriter import LogWriter
+from multivac.scheduler import Scheduler
+from multivac.watch import FileWatcher
 
 log = logging.getLogger('multivac')
 
-pending_job_timeout = 300
+# seconds between retention sweeps
+retention_interval = 60
+
+# jobs deleted per retention pass, and passes per sweep; a sweep that
+# reaches its limit continues on the next tick so heartbeats keep going
+expire_batch = 1000
+expire_passes = 5
+
+# seconds a worker waits before claiming when a less loaded worker
+# has a free slot
+placement_delay = 0.1
+
+# flush a partial line of output once it grows beyond this many bytes
+max_line_bytes = 65536
+
+config_defaults = { 'max_concurrent_jobs': 50,
+                    'log_flush_lines': 100,
+                    'log_flush_ms': 100,
+                    'job_log_max_lines': None,
+                    'job_ttl': None,
+                    'max_jobs': None }
 
 action_defaults = { 'allow_groups': 'all',
                     'chatbot_stream': True,
-                    'confirm_required': False }
+                    'confirm_required': False,
+                    'priority': 0 }
 
 class JobWorker(object):
     """
@@ -30,163 +56,318 @@ class JobWorker(object):
     """
     def __init__(self, redis_host, redis_port, config_path):
         self.pids = {}  # dict of job_id:subprocess object
+        self.watcher = None
+        self.running = 0  # number of claimed jobs not yet completed
+        self.hostname = socket.getfqdn()
         self.db = JobsDB(redis_host, redis_port)
+        self.db.index_jobs()
 
         self.config_path = config_path
         self.read_config(self.config_path)
         self.name = self._get_name()
 
-        self.executor = ThreadPoolExecutor(max_workers=10)
+        # threads for blocking redis calls made from the event loop
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.writer = LogWriter(self.db,
+                                flush_lines=self.config['log_flush_lines'],
+                                flush_ms=self.config['log_flush_ms'],
+                                max_lines=self.config['job_log_max_lines'])
+        metrics.start_pusher(self.db, 'worker-' + self.name,
+                             collect=self._collect_metrics)
+        self.scheduler = Scheduler(self.db, self.name)
 
         self.run()
 
     def run(self):
         print('Starting Multivac Job Worker %s' % self.name)
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self.loop = asyncio.get_event_loop()
+        self.slot_count = self.config['max_concurrent_jobs']
+        self.slots = asyncio.Semaphore(self.slot_count)
+
+        # register before claiming so our claimed jobs are never
+        # mistaken for those of a lost worker
+        await self._db(self._heartbeat)
+        asyncio.ensure_future(self._periodic())
+        self._watch_config()
+
+        while True:
+            # only claim work while a job slot is free
+            await self.slots.acquire()
+
+            # give a less loaded worker the first chance at queued jobs
+            preferred = await self._db(self.db.least_loaded_worker)
+            if preferred and preferred != self.name:
+                await asyncio.sleep(placement_delay)
+
+            # block for up to a second waiting for a ready job
+            job = await self._db(self.db.claim_job, self.name, timeout=1)
+            if job:
+                self.running += 1
+                task = asyncio.ensure_future(self._run_job(job))
+                task.add_done_callback(self._job_done)
+            else:
+                self.slots.release()
+
+    def _resize_slots(self):
+        """
+        Apply a changed max_concurrent_jobs to the job slots. Slots taken
+        away are freed as running jobs complete
+        """
+        count = self.config['max_concurrent_jobs']
+        for _ in range(count - self.slot_count):
+            self.slots.release()
+        for _ in range(self.slot_count - count):
+            asyncio.ensure_future(self.slots.acquire())
+        self.slot_count = count
+
+    def _job_done(self, task):
+        self.running -= 1
+        self.slots.release()
+        if task.exception():
+            log.error('job failed: %s' % task.exception())
+
+    async def _periodic(self):
+        """
+        Send a heartbeat with current capacity every second, and run
+        config and job maintenance
+        """
+        last_sweep = 0
         while True:
-            self.db.register_worker(self.name, socket.getfqdn())
-
-            # spawn ready jobs
-            for job in self.db.get_jobs(status='ready'):
-                self.executor.submit(self._job_worker, job)
-
-            # collect ended processes
-            pids = deepcopy(self.pids)
-            for job_id, pid in pids.items():
-                if not self._is_running(pid):
-                    self.db.cleanup_job(job_id)
-                    del self.pids[job_id]
-                    print('completed job %s' % job['id'])
-
-            # re-read config if modified
-            if os.stat(self.config_path).st_mtime != self.config_mtime:
-                log.warn('re-reading modified config %s' % self.config_path)
-                self.read_config(self.config_path)
-
-            # cancel pending jobs exceeding timeout
             now = time()
-            for job in self.db.get_jobs(status='pending'):
-                if (now - int(job['created'])) > pending_job_timeout:
-                    print('canceling unconfirmed job %s' % job['id'])
-                    self.db.cancel_job(job['id'])
+            sweep = now - last_sweep > retention_interval
+            if sweep:
+                last_sweep = now
 
-            sleep(1)
+            try:
+                await self._db(self._heartbeat)
+                if await self._db(self._housekeeping, now, sweep):
+                    # retention limits not yet met, sweep again next tick
+                    last_sweep = 0
+            except Exception as e:
+                log.error('error in worker maintenance: %s' % e)
+
+            await asyncio.sleep(1)
+
+    def _db(self, func, *args, **kwargs):
+        """
+        Run a blocking database call in the executor, returning an awaitable
+        """
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor,
+                                    partial(func, *args, **kwargs))
+
+    def _heartbeat(self):
+        self.db.register_worker(self.name,
+                                self.hostname,
+                                slots=self.slot_count,
+                                running=self.running,
+                                load=os.getloadavg()[0])
+
+    def _collect_metrics(self):
+        metrics.registry.set('multivac_worker_running_jobs', self.running,
+                             help='Jobs claimed and not yet completed')
+
+    def _housekeeping(self, now, sweep=False):
+        """
+        Periodic config and job maintenance. Returns True if a sweep
+        stopped before all jobs exceeding retention limits were deleted
+        params:
+         - sweep(bool): also delete jobs exceeding retention limits
+        """
+        # re-read config if modified and not watched
+        if not self.watcher and \
+           os.stat(self.config_path).st_mtime != self.config_mtime:
+            self._reload_config()
+
+        # requeue jobs claimed by workers that have gone away
+        self.db.requeue_orphaned_jobs()
+
+        # delete finished jobs exceeding retention limits
+        unfinished = False
+        if sweep:
+            deleted = self.db.expire_jobs(ttl=self.config['job_ttl'],
+                                          max_jobs=self.config['max_jobs'],
+                                          batch=expire_batch,
+                                          max_passes=expire_passes)
+            unfinished = deleted >= expire_batch * expire_passes
+
+        # cancel pending jobs exceeding their confirm timeout
+        for job_id in self.db.cancel_unconfirmed_jobs(now):
+            print('canceled unconfirmed job %s' % job_id)
+
+        return unfinished
 
     def read_config(self, path):
+        """
+        Load config file, applying any changes to actions and groups
+        """
         with open(path, 'r') as of:
             config = yaml.load(of.read())
 
         self.config_mtime = os.stat(path).st_mtime
+        new_config = deepcopy(config_defaults)
+        new_config.update(config)
+
+        groups = config.get('groups') or {}
+        actions = self._read_actions(config['actions'], groups)
+        self.config = new_config
+        if hasattr(self, 'slots'):
+            self.loop.call_soon_threadsafe(self._resize_slots)
+
+        # version by content so formatting-only edits are not reapplied
+        content = json.dumps([actions, groups], sort_keys=True, default=str)
+        version = hashlib.sha1(content.encode()).hexdigest()
+        if self.db.load_config(version, actions, groups):
+            log.info('loaded config version %s' % version)
+        else:
+            log.info('config version %s already loaded' % version)
 
-        if 'groups' in config:
-            self._read_groups(config['groups'])
-        self._read_actions(config['actions'])
-
-    def _read_groups(self, groups):
-        self.db.purge_groups()
-        for group,members in groups.items():
-            self.db.add_group(group, members)
-            log.info('loaded group %s' % (group))
-
-    def _read_actions(self, actions):
-        self.db.purge_actions()
+    def _read_actions(self, actions, groups):
+        new_actions = []
         for a in actions:
 
             if 'allow_groups' in a.keys():
-                a['allow_groups'] = self._read_action_groups(a['allow_groups'])
+                a['allow_groups'] = self._read_action_groups(a['allow_groups'],
+                                                             groups)
 
             new_action = deepcopy(action_defaults)
             new_action.update(a)
 
-            self.db.add_action(new_action)
-            log.info('loaded action %s' % (new_action['name']))
-
-    def _read_action_groups(self, groups):
+            if new_action.get('schedule'):
+                try:
+                    parse_cron(new_action['schedule'])
+                except ValueError as e:
+                    log.warn('ignoring schedule of action %s: %s' % \
+                             (new_action['name'], e))
+                    del new_action['schedule']
+
+            for key in ('confirm_timeout', 'max_concurrent', 'max_queued'):
+                if key not in new_action:
+                    continue
+                try:
+                    new_action[key] = int(new_action[key])
+                except (TypeError, ValueError):
+                    log.warn('ignoring invalid %s of action %s' % \
+                             (key, new_action['name']))
+                    del new_action[key]
+
+            new_actions.append(new_action)
+            log.info('read action %s' % (new_action['name']))
+
+        return new_actions
+
+    def _read_action_groups(self, groups, defined_groups):
         if not isinstance(groups, list):
             log.warn('unable to parse allow_groups, defaulting to "all"')
             return 'all'
 
-        defined_groups = self.db.get_groups().keys()
         for g in groups:
             if g not in defined_groups:
                 log.warn('no such user group defined: %s' % g)
 
         return ','.join(groups)
 
+    def _watch_config(self):
+        """
+        Reload config when the file changes, using inotify where available
+        and otherwise falling back to checking its mtime periodically
+        """
+        try:
+            self.watcher = FileWatcher(self.config_path)
+        except OSError as e:
+            log.warn('unable to watch config, polling instead: %s' % e)
+            self.watcher = None
+            return
+
+        def changed():
+            if self.watcher.read():
+                asyncio.ensure_future(self._db(self._reload_config))
+
+        asyncio.get_event_loop().add_reader(self.watcher.fileno(), changed)
+
+    def _reload_config(self):
+        log.warn('re-reading modified config %s' % self.config_path)
+        try:
+            self.read_config(self.config_path)
+        except Exception as e:
+            log.error('error reading config %s: %s' % (self.config_path, e))
+
     def _get_name(self):
         """
         Randomly generate a unique name for this worker
         """
         name = names.get_first_name()
-        if name in self.db.get_workers():
-            self._get_name()
+        if name in [ w['name'] for w in self.db.get_workers() ]:
+            return self._get_name()
         else:
             return name
 
-    def _is_running(self, pid):
-        try:
-            os.kill(pid, 0)
-        except OSError:
-            return False
-        return True
-
-    def _job_worker(self, job):
+    async def _run_job(self, job):
         print('running job %s' % job['id'])
-        self.db.update_job(job['id'], 'status', 'running')
+        try:
+            await self._db(self.db.update_job, job['id'], 'status', 'running')
+            queued = float(job.get('queued') or job['created'])
+            metrics.registry.observe('multivac_job_start_delay_seconds',
+                                     time() - queued,
+                                     help='Time from a job being queued to start')
 
-        if job['args']:
             cmdline = shlex.split(job['cmd'] + ' ' + job['args'])
-        else:
-            cmdline = job['cmd']
-
-        print(cmdline)
-        proc = subprocess.Popen(
-            cmdline,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-
-        self.pids[job['id']] = proc.pid
 
-        self.executor.submit(self._log_worker,
-                             job['id'],
-                             proc.stdout,
-                             proc.stderr)
-
-        proc.wait()
-
-    def _log_worker(self, job_id, stdout, stderr):
-        log.debug('Log handler started for job %s' % job_id)
+            print(cmdline)
+            proc = await asyncio.create_subprocess_exec(
+                *cmdline,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+
+            self.pids[job['id']] = proc.pid
+
+            # collect all output written before exit
+            await asyncio.gather(self._read_output(job['id'], proc.stdout),
+                                 self._read_output(job['id'], proc.stderr),
+                                 proc.wait())
+        except Exception as e:
+            log.error('error running job %s: %s' % (job['id'], e))
+            self.writer.write(job['id'], 'Failed to run job: %s' % e)
+        finally:
+            self.pids.pop(job['id'], None)
+            await self._db(self._complete, job['id'])
+
+    async def _read_output(self, job_id, stream):
+        """
+        Read a job output stream until EOF, splitting it into lines
+        """
+        buf = b''
         while True:
-            output = self._read(stdout)
-            error = self._read(stderr)
-            if output:
-                output = self._sanitize(output)
-                self.db.append_job_log(job_id, output)
-                log.debug('%s-STDOUT: %s' % (job_id, output))
-            if error:
-                error = self._sanitize(error)
-                self.db.append_job_log(job_id, error)
-                log.debug('%s-STDOUT: %s' % (job_id, error))
-
-            #TODO: do final read of stdout/stderr streams before exiting
-            # exit when job has been collected
-            if job_id not in self.pids:
-                log.debug('Log handler stopped for job %s' % job_id)
-                return
-
-    def _sanitize(self, line):
-        line = line.decode('utf-8')
-        line = line.replace('\n', '')
-
-        return line
-
-    def _read(self, pipe):
-        """
-        Non-blocking method for reading fd
-        """
-        fd = pipe.fileno()
-        fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-        fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-        try:
-            return pipe.read()
-        except:
-            return ""
+            data = await stream.read(65536)
+            if not data:
+                break
+            metrics.registry.inc('multivac_job_output_bytes_total', len(data),
+                                 help='Bytes of job output read')
+
+            *lines, buf = (buf + data).split(b'\n')
+            for line in lines:
+                self._log_output(job_id, line)
+
+            if len(buf) > max_line_bytes:
+                self._log_output(job_id, buf)
+                buf = b''
+
+        # flush any trailing partial line
+        if buf:
+            self._log_output(job_id, buf)
+
+    def _complete(self, job_id):
+        self.writer.flush(job_id)
+        self.db.cleanup_job(job_id)
+        self.db.release_job(self.name, job_id)
+        print('completed job %s' % job_id)
+
+    def _log_output(self, job_id, line):
+        metrics.registry.inc('multivac_job_output_lines_total',
+                             help='Lines of job output logged')
+        line = line.rstrip(b'\r').decode('utf-8', errors='replace')
+        self.writer.write(job_id, line)
+        log.debug('%s-OUTPUT: %s' % (job_id, line))
@@ -5,8 +5,8 @@ exec(open('multivac/version.py').read())
 requirements = [ 'slacksocket>=0.7.0',
                  'Flask>=0.10.1',
                  'Flask-RESTful>=0.3.2',
-                 'gevent>=1.1b1',
-                 'redis>=2.10.3',
+                 'gevent>=1.4.0',
+                 'redis>=3.0.0',
                  'names>=0.3.0',
                  'PyYAML>=3.11',
                  'termcolor>=1.1.0' ]
@@ -20,6 +20,7 @@ setup(
     author_email='bradley@vektor.nyc',
     url='https://github.com/vektorlab/multivac',
     install_requires=requirements,
+    python_requires='>=3.7',
     package_data={ 'multivac': ['templates/*', 'static/*'] },
     include_package_data=True,
     license='http://opensource.org/licenses/MIT',
@@ -28,7 +29,7 @@ setup(
         'Natural Language :: English',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.7',
         'Development Status :: 5 - Production/Stable',
     ),
     keywords='slack rtm websocket api chatops bot',